@@ -5,7 +5,7 @@
 
 import io
 import datetime
-from streams import FileStream
+from streams import AsyncStream, FileStream
 
 
 class AVI:
@@ -17,7 +17,37 @@ class AVI:
 
     def load(self, file_path):
         self.file_path = file_path
-        self.stream = FileStream(file_path, 'rb')
+        self.load_stream(FileStream(file_path, 'rb', read_ahead=FileStream.DEFAULT_READ_AHEAD))
+
+    # Load from an asyncio.StreamReader or a file path without blocking the event loop
+    # The movie data and index are skipped rather than held, as only the header lists hold metadata
+    async def load_async(self, source):
+        stream = AsyncStream(source)
+        if await stream.fill(12) == 12:
+            stream.set_position(4)
+            end_position = 8 + stream.read_u32()
+            while stream.get_length() < end_position and await stream.fill(8) == 8:
+                stream.set_position(stream.get_length() - 8)
+                chunk_id = stream.read_string(4)
+                chunk_size = stream.read_u32()
+                if chunk_id == 'LIST':
+                    if await stream.fill(4) < 4:
+                        break
+                    list_type = stream.read_string(4)
+                    chunk_size -= 4
+                    if list_type == 'movi':
+                        await stream.skip(chunk_size)
+                        continue
+                elif chunk_id in ('idx1', 'JUNK'):
+                    await stream.skip(chunk_size)
+                    continue
+                await stream.fill(chunk_size)
+            stream.set_position(0)
+        self.file_path = stream.file_name
+        self.load_stream(stream)
+
+    def load_stream(self, stream):
+        self.stream = stream
         signature = self.stream.read_string(4)
         if signature != 'RIFF':
             raise ValueError
@@ -33,6 +63,9 @@ class AVI:
             chunk_size = self.stream.read_u32()
             if chunk_id == 'LIST':
                 list_type = self.stream.read_string(4)
+                if list_type == 'movi':             # movie data holds no metadata
+                    self.stream.set_position(chunk_size - 4, io.SEEK_CUR)
+                    continue
                 self.chunk_type_stack.append(list_type)
                 self.parse_chunks(self.stream.get_position() + chunk_size)
                 self.chunk_type_stack.pop()
@@ -5,11 +5,414 @@
 # For EXIF format see http://www.exif.org/Exif2-2.PDF
 
 import io
+import array
 import struct
 import datetime
-import xml.etree.ElementTree as ET
-from streams import ByteStream, FileStream
+import threading
+import collections
+import concurrent.futures
+from streams import AsyncStream, FileStream, MmapStream
 from tiff import TIFF
+from xmp import find_properties
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Natural (row major) index of each coefficient in zigzag order
+ZIGZAG = (
+    0, 1, 8, 16, 9, 2, 3, 10, 17, 24, 32, 25, 18, 11, 4, 5,
+    12, 19, 26, 33, 40, 48, 41, 34, 27, 20, 13, 6, 7, 14, 21, 28,
+    35, 42, 49, 56, 57, 50, 43, 36, 29, 22, 15, 23, 30, 37, 44, 51,
+    58, 59, 52, 45, 38, 31, 39, 46, 53, 60, 61, 54, 47, 55, 62, 63
+)
+
+
+class HuffmanTable:
+    """
+    Decoding table for one Huffman table of a DHT segment. Codes of up to LOOKUP_BITS bits are decoded with a single
+    lookup of the next LOOKUP_BITS bits of the stream; longer codes fall back to a search of the canonical code ranges.
+    """
+
+    LOOKUP_BITS = 9
+
+    def __init__(self, counts, symbols):
+        self.symbols = bytes(symbols)
+
+        # Lookup entries hold (code length << 8) | symbol, or 0 if the code is longer than LOOKUP_BITS
+        self.lookup = [0] * (1 << self.LOOKUP_BITS)
+        self.max_code = [-1] * 17
+        self.value_offset = [0] * 17
+        code = 0
+        index = 0
+        for length in range(1, 17):
+            count = counts[length - 1]
+            if count:
+                self.value_offset[length] = index - code
+                for i in range(count):
+                    if length <= self.LOOKUP_BITS:
+                        shift = self.LOOKUP_BITS - length
+                        entry = (length << 8) | symbols[index]
+                        start = code << shift
+                        self.lookup[start:start + (1 << shift)] = [entry] * (1 << shift)
+                    code += 1
+                    index += 1
+                self.max_code[length] = code - 1
+            code <<= 1
+
+
+class JPEGComponent:
+    """
+    Image component described by the frame header. After decoding, coefficients holds the quantized DCT coefficients
+    of blocks_high x blocks_wide blocks, each of 64 coefficients in natural order.
+    """
+
+    __slots__ = ('id', 'h', 'v', 'quantization_table_id', 'blocks_wide', 'blocks_high', 'coefficients')
+
+    def __init__(self, id, h, v, quantization_table_id):
+        self.id = id
+        self.h = h
+        self.v = v
+        self.quantization_table_id = quantization_table_id
+        self.blocks_wide = 0
+        self.blocks_high = 0
+        self.coefficients = None
+
+    # Return the coefficients as a (blocks_high, blocks_wide, 8, 8) NumPy array if as_numpy is set and NumPy is
+    # installed, otherwise as the flat array
+    def get_blocks(self, as_numpy=False):
+        if as_numpy and numpy is not None:
+            values = numpy.frombuffer(self.coefficients, numpy.int16)
+            return values.reshape(self.blocks_high, self.blocks_wide, 8, 8)
+        return self.coefficients
+
+
+# Parse the tables of a DHT segment; returns a list of (table class, table id, HuffmanTable)
+def parse_huffman_tables(data):
+    tables = []
+    position = 0
+    while position + 17 <= len(data):
+        table_class = data[position] >> 4
+        table_id = data[position] & 0x0f
+        counts = data[position + 1:position + 17]
+        num_symbols = sum(counts)
+        symbols = data[position + 17:position + 17 + num_symbols]
+        tables.append((table_class, table_id, HuffmanTable(counts, symbols)))
+        position += 17 + num_symbols
+    return tables
+
+
+# Parse the tables of a DQT segment; returns a list of (table id, values in natural order)
+def parse_quantization_tables(data):
+    tables = []
+    position = 0
+    while position < len(data):
+        precision = data[position] >> 4
+        table_id = data[position] & 0x0f
+        values = [0] * 64
+        if precision == 0:
+            for i in range(64):
+                values[ZIGZAG[i]] = data[position + 1 + i]
+            position += 65
+        else:
+            for i in range(64):
+                values[ZIGZAG[i]] = (data[position + 1 + i * 2] << 8) | data[position + 2 + i * 2]
+            position += 129
+        tables.append((table_id, values))
+    return tables
+
+
+class TableCache:
+    """
+    Process-wide cache of DQT and DHT tables keyed by their content. Files from the same encoder repeat the same few
+    tables, so interning the raw tables shares one copy between every loaded JPEG, and caching the tables derived from
+    them (such as HuffmanTable lookups) avoids rebuilding them for every file. The least recently used entries are
+    evicted once max_entries is reached.
+    """
+
+    DEFAULT_MAX_ENTRIES = 1024
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Return the shared bytes object with the same content as data
+    def intern(self, data):
+        return self.get(None, data)
+
+    # Return parse(data) for the content of data, calling parse only if it is not cached; parse(None) interns data
+    def get(self, parse, data):
+        key = (parse, bytes(data))
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = key[1] if parse is None else parse(key[1])
+        with self.lock:
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_statistics(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries), 'max_entries': self.max_entries}
+
+
+table_cache = TableCache()
+
+
+# Decode the entropy coded data of one restart interval of a sequential scan
+# blocks is a sequence of (coefficients, offset of block, dc table, ac table, component index) in decoding order
+def decode_sequential_blocks(data, blocks, num_components):
+    predictions = [0] * num_components
+    zigzag = ZIGZAG
+    length = len(data)
+    position = 0
+    bits = 0                # bit buffer
+    num_bits = 0            # number of valid bits in the bit buffer
+    for coefficients, offset, dc_table, ac_table, index in blocks:
+        table = dc_table
+        k = 0
+        while k < 64:
+            # Ensure the buffer holds the longest code plus the longest magnitude; the stream is padded with zeros
+            while num_bits < 27:
+                bits = ((bits & 0xffffffff) << 8) | (data[position] if position < length else 0)
+                position += 1
+                num_bits += 8
+
+            entry = table.lookup[(bits >> (num_bits - 9)) & 0x1ff]
+            if entry:
+                num_bits -= entry >> 8
+                symbol = entry & 0xff
+            else:
+                code_length = 10
+                code = (bits >> (num_bits - 10)) & 0x3ff
+                while code > table.max_code[code_length]:
+                    code_length += 1
+                    if code_length > 16:
+                        raise ValueError("Invalid Huffman code")
+                    code = (bits >> (num_bits - code_length)) & ((1 << code_length) - 1)
+                num_bits -= code_length
+                symbol = table.symbols[code + table.value_offset[code_length]]
+
+            if k == 0:
+                # DC coefficient is coded as a difference from the previous block of the component
+                if symbol:
+                    value = (bits >> (num_bits - symbol)) & ((1 << symbol) - 1)
+                    num_bits -= symbol
+                    if value < (1 << (symbol - 1)):
+                        value -= (1 << symbol) - 1
+                    predictions[index] += value
+                coefficients[offset] = predictions[index]
+                table = ac_table
+                k = 1
+            else:
+                run = symbol >> 4
+                size = symbol & 0x0f
+                if size:
+                    k += run
+                    if k > 63:
+                        raise ValueError("Invalid AC coefficient run")
+                    value = (bits >> (num_bits - size)) & ((1 << size) - 1)
+                    num_bits -= size
+                    if value < (1 << (size - 1)):
+                        value -= (1 << size) - 1
+                    coefficients[offset + zigzag[k]] = value
+                    k += 1
+                elif run == 15:
+                    k += 16
+                else:
+                    break
+
+
+# Decode a batch of restart intervals of a sequential scan on a worker process; intervals is a list of (interval data
+# with stuffing removed, number of blocks) and pattern lists the (dc table, ac table, component index in the scan) of
+# each block of an MCU. Returns the coefficients of every block of the batch in decoding order
+def decode_sequential_intervals(intervals, pattern, num_components):
+    coefficients = array.array('h', bytes(sum(num_blocks for data, num_blocks in intervals) * 128))
+    offset = 0
+    for data, num_blocks in intervals:
+        blocks = [(coefficients, offset + i * 64) + pattern[i % len(pattern)] for i in range(num_blocks)]
+        decode_sequential_blocks(data, blocks, num_components)
+        offset += num_blocks * 64
+    return coefficients
+
+
+# Set the block dimensions of each component, including the blocks that pad the image to a whole number of MCUs
+def set_block_dimensions(components, width, height):
+    h_max = max(component.h for component in components)
+    v_max = max(component.v for component in components)
+    mcus_wide = (width + 8 * h_max - 1) // (8 * h_max)
+    mcus_high = (height + 8 * v_max - 1) // (8 * v_max)
+    for component in components:
+        component.blocks_wide = mcus_wide * component.h
+        component.blocks_high = mcus_high * component.v
+
+
+# List the blocks of a scan in decoding order as (coefficients, offset of block, dc table, ac table, component index in
+# the scan) where each block holds block_size coefficients; returns the blocks and the number of blocks per MCU
+def list_scan_blocks(header, components, huffman_tables, width, height, block_size):
+    h_max = max(component.h for component in components)
+    v_max = max(component.v for component in components)
+    scan_components = []
+    for i in range(header[0]):
+        component = next(c for c in components if c.id == header[1 + i * 2])
+        selectors = header[2 + i * 2]
+        scan_components.append((component, huffman_tables.get((0, selectors >> 4)),
+                                huffman_tables.get((1, selectors & 0x0f)), i))
+
+    blocks = []
+    if len(scan_components) == 1:
+        # A non-interleaved scan covers only the blocks within the component's own dimensions, in raster order
+        component, dc_table, ac_table, index = scan_components[0]
+        component_width = (width * component.h + h_max - 1) // h_max
+        component_height = (height * component.v + v_max - 1) // v_max
+        for y in range((component_height + 7) // 8):
+            for x in range((component_width + 7) // 8):
+                offset = (y * component.blocks_wide + x) * block_size
+                blocks.append((component.coefficients, offset, dc_table, ac_table, 0))
+        return blocks, 1
+
+    mcus_wide = (width + 8 * h_max - 1) // (8 * h_max)
+    mcus_high = (height + 8 * v_max - 1) // (8 * v_max)
+    for mcu_y in range(mcus_high):
+        for mcu_x in range(mcus_wide):
+            for component, dc_table, ac_table, index in scan_components:
+                for v in range(component.v):
+                    row = (mcu_y * component.v + v) * component.blocks_wide + mcu_x * component.h
+                    for h in range(component.h):
+                        blocks.append((component.coefficients, (row + h) * block_size, dc_table, ac_table, index))
+    return blocks, sum(component.h * component.v for component, _, _, _ in scan_components)
+
+
+# Decode the DC coefficients of one restart interval of a progressive DC scan; the first scan codes the coefficients
+# shifted right by point_transform and each refinement scan codes one more bit per block
+def decode_dc_blocks(data, blocks, num_components, point_transform, refine):
+    predictions = [0] * num_components
+    length = len(data)
+    position = 0
+    bits = 0
+    num_bits = 0
+    for coefficients, offset, dc_table, ac_table, index in blocks:
+        while num_bits < 27:
+            bits = ((bits & 0xffffffff) << 8) | (data[position] if position < length else 0)
+            position += 1
+            num_bits += 8
+
+        if refine:
+            num_bits -= 1
+            if (bits >> num_bits) & 1:
+                coefficients[offset] |= 1 << point_transform
+            continue
+
+        entry = dc_table.lookup[(bits >> (num_bits - 9)) & 0x1ff]
+        if entry:
+            num_bits -= entry >> 8
+            symbol = entry & 0xff
+        else:
+            code_length = 10
+            code = (bits >> (num_bits - 10)) & 0x3ff
+            while code > dc_table.max_code[code_length]:
+                code_length += 1
+                if code_length > 16:
+                    raise ValueError("Invalid Huffman code")
+                code = (bits >> (num_bits - code_length)) & ((1 << code_length) - 1)
+            num_bits -= code_length
+            symbol = dc_table.symbols[code + dc_table.value_offset[code_length]]
+
+        if symbol:
+            value = (bits >> (num_bits - symbol)) & ((1 << symbol) - 1)
+            num_bits -= symbol
+            if value < (1 << (symbol - 1)):
+                value -= (1 << symbol) - 1
+            predictions[index] += value
+        coefficients[offset] = predictions[index] << point_transform
+
+
+# Upsample a plane of samples by factor along axis. Doubling interpolates with weights of 3/4 and 1/4 between each
+# sample and its nearest neighbour like libjpeg's fancy upsampling; other factors replicate samples
+def upsample(plane, factor, axis):
+    if factor == 1:
+        return plane
+    if factor != 2:
+        return numpy.repeat(plane, factor, axis)
+    plane = numpy.moveaxis(plane, axis, 0)
+    nearer = plane * numpy.float32(0.75)
+    result = numpy.empty((plane.shape[0] * 2,) + plane.shape[1:], plane.dtype)
+    even = result[0::2]
+    odd = result[1::2]
+    numpy.multiply(plane[:-1], numpy.float32(0.25), out=even[1:])
+    even[0] = plane[0] * numpy.float32(0.25)
+    even += nearer
+    numpy.multiply(plane[1:], numpy.float32(0.25), out=odd[:-1])
+    odd[-1] = plane[-1] * numpy.float32(0.25)
+    odd += nearer
+    return numpy.moveaxis(result, 0, axis)
+
+
+# Convert decoded component planes to an image of the given size; three component images are converted from YCbCr to RGB
+def convert_planes(planes, width, height, precision):
+    planes = [plane[:height, :width] for plane in planes]
+    if len(planes) == 3:
+        # JFIF YCbCr to RGB; chroma is still centred on the level shift
+        y, cb, cr = planes
+        cb = cb - numpy.float32(1 << (precision - 1))
+        cr = cr - numpy.float32(1 << (precision - 1))
+        planes = [y + numpy.float32(1.402) * cr,
+                  y - numpy.float32(0.344136) * cb - numpy.float32(0.714136) * cr,
+                  y + numpy.float32(1.772) * cb]
+
+    # Round and clamp each plane before interleaving them
+    pixels = numpy.empty((height, width, len(planes)), numpy.uint8 if precision == 8 else numpy.uint16)
+    for i, plane in enumerate(planes):
+        plane = numpy.rint(plane)
+        numpy.clip(plane, 0, (1 << precision) - 1, out=plane)
+        pixels[:, :, i] = plane
+    return pixels[:, :, 0] if len(planes) == 1 else pixels
+
+
+class JPEGScan:
+    """
+    Location of the entropy coded segment of one scan. Offsets are file offsets; restart_offsets holds the offset of
+    each RSTn marker and stuffing_offsets the offset of each 0xff byte that is followed by a stuffed zero byte.
+    tables holds the (marker, data) of the DHT and DQT segments between the previous scan and this one.
+    """
+
+    __slots__ = ('header', 'offset', 'length', 'restart_interval', 'restart_offsets', 'stuffing_offsets', 'tables')
+
+    def __init__(self, header, offset, restart_interval):
+        self.header = header
+        self.offset = offset
+        self.length = 0
+        self.restart_interval = restart_interval
+        self.restart_offsets = array.array('Q')
+        self.stuffing_offsets = array.array('Q')
+        self.tables = []
+
+    # Return the offset and length of each restart interval, excluding the restart markers themselves
+    # Each interval can be decoded independently of the others
+    def get_intervals(self):
+        intervals = []
+        start = self.offset
+        for restart_offset in self.restart_offsets:
+            intervals.append((start, restart_offset - start))
+            start = restart_offset + 2
+        intervals.append((start, self.offset + self.length - start))
+        return intervals
 
 
 class JPEG:
@@ -22,20 +425,67 @@ class JPEG:
         self.x_thumbnail = 0
         self.y_thumbnail = 0
         self.thumbnail_image = None
+        self.jfxx_extension = 0
+        self.jfxx_thumbnail = None
+        self.exif_thumbnail = None
         self.quantization_tables = []
         self.huffman_tables = []
         self.comments = []
+        self.segments = []
+        self.frame_type = 0
         self.frame_start = None
+        self.components = []
         self.scan_header = None
         self.scan_data = None
+        self.scan_data_offset = 0
+        self.scan_data_length = 0
+        self.restart_interval = 0
+        self.scans = []
         self.exif = None
+        self.tiff = None
+        self.tag_values = {}
         self.image_time = None
+        # XMP properties to extract into self.xmp when loading; callers can add their own before loading
+        self.xmp_property_names = ['exif:DateTimeOriginal']
+        self.xmp = {}
 
-    def load(self, file_path):
+    # If use_mmap is set then the file is memory mapped and scan data and thumbnail are views of the mapping; tables
+    # are always interned copies shared through table_cache
+    # If metadata_only is set then parsing stops at the start of scan and the scan data is only read if it is accessed
+    # If want is set to a collection of Exif tags, as accepted by TIFF.find_tags, then only those tags are read into
+    # tag_values and parsing stops after the Exif segment
+    def load(self, file_path, use_mmap=False, metadata_only=False, want=None):
         self.file_path = file_path
-        stream = FileStream(file_path, 'rb', FileStream.BIG_ENDIAN)
+        if use_mmap:
+            stream = MmapStream(file_path, MmapStream.BIG_ENDIAN)
+        else:
+            stream = FileStream(file_path, 'rb', FileStream.BIG_ENDIAN, FileStream.DEFAULT_READ_AHEAD)
+        self.load_stream(stream, metadata_only, want)
 
+    # Load from an asyncio.StreamReader or a file path without blocking the event loop
+    # As with metadata_only, the segments up to the start of scan are held and the scan data is skipped; it can be read
+    # later only when loaded from a file path
+    async def load_async(self, source):
+        stream = AsyncStream(source, AsyncStream.BIG_ENDIAN)
+        if await stream.fill(2) == 2:
+            # Every marker after the start of image and before the start of scan has a length
+            while await stream.fill(4) == 4:
+                stream.set_position(stream.get_length() - 4)
+                marker, length = stream.read_struct('HH')
+                await stream.fill(length - 2)
+                if marker == 0xffda:
+                    break
+            await stream.skip()
+            stream.set_position(0)
+        self.file_path = stream.file_name
+        self.load_stream(stream, metadata_only=True)
+
+    def load_stream(self, stream, metadata_only=False, want=None):
+        # Only metadata is wanted if specific tags are requested
+        if want is not None:
+            metadata_only = True
         while not stream.is_eof():
+            offset = stream.get_position()
             marker = stream.read_u16()
 
             # start of image marker
@@ -55,6 +505,10 @@ class JPEG:
                     self.x_thumbnail = stream.read_u8()
                     self.y_thumbnail = stream.read_u8()
                     self.thumbnail_image = stream.read_u8_array(self.x_thumbnail * self.y_thumbnail * 3)
+                elif identifier == 0x4a465858:          # 'jfxx'
+                    # Extension 0x10 holds a JPEG thumbnail, 0x11 and 0x13 a palette or RGB thumbnail with its size
+                    self.jfxx_extension = stream.read_u8()
+                    self.jfxx_thumbnail = stream.read_u8_array(length - 6)
                 else:
                     raise ValueError
 
@@ -69,22 +523,32 @@ class JPEG:
                     stream.push_endian()
                     t = TIFF()
                     t.init(stream)
-                    t.parse()
+                    if want is None:
+                        t.parse()
+                    else:
+                        self.tag_values = t.find_tags(want)
+                        # The last valid date in the order ModifyDate, DateTimeOriginal, CreateDate is the image time
+                        for tag in (0x0132, 0x9003, 0x9004):
+                            if isinstance(self.tag_values.get(tag), str):
+                                t.image_time = TIFF.parse_time(self.tag_values[tag]) or t.image_time
+                    self.tiff = t
+                    if t.thumbnail_offset and t.thumbnail_offset + t.thumbnail_length <= position + length:
+                        self.exif_thumbnail = t.get_thumbnail()
                     stream.pop_endian()
                     stream.set_position(position + length)
                     if not self.image_time:
                         self.image_time = t.get_image_time()
+                    if want is not None:
+                        break
 
                 # Adobe 'http' metadata or 'XMP\x00' metadata
                 elif signature == 'http' or signature == 'XMP\x00':
                     url_string = stream.read_nt_string()
                     text_length = length - len(url_string) - 5
-                    text = stream.read_string(text_length)
-                    text = text.rstrip(' \r\n\x00')
-                    xml_root = ET.fromstring(text)
-                    element = xml_root.find('.//{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description[@{http://ns.adobe.com/exif/1.0/}DateTimeOriginal]')
-                    if element is not None:
-                        timestamp = element.attrib['{http://ns.adobe.com/exif/1.0/}DateTimeOriginal'][0:19]
+                    text = stream.read_u8_array(text_length)
+                    self.xmp.update(find_properties(text, self.xmp_property_names))
+                    if 'exif:DateTimeOriginal' in self.xmp:
+                        timestamp = self.xmp['exif:DateTimeOriginal'][0:19]
                         self.image_time = datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
                 else:
                     raise ValueError
@@ -171,40 +635,48 @@ class JPEG:
             # quantization table marker
             elif marker == 0xffdb:
                 length = stream.read_u16() - 2
-                self.quantization_tables.append(stream.read_u8_array(length))
+                self.quantization_tables.append(table_cache.intern(stream.read_u8_array(length)))
 
             # huffman table marker
             elif marker == 0xffc4:
                 length = stream.read_u16() - 2
-                self.huffman_tables.append(stream.read_u8_array(length))
+                self.huffman_tables.append(table_cache.intern(stream.read_u8_array(length)))
 
             # start of frame marker (Baseline DCT)
             elif marker == 0xffc0:
                 length = stream.read_u16() - 2
+                self.frame_type = marker
                 self.frame_start = stream.read_u8_array(length)
 
             # start of frame marker (Progressive DCT)
             elif marker == 0xffc2:
                 length = stream.read_u16() - 2
+                self.frame_type = marker
                 self.frame_start = stream.read_u8_array(length)
 
             # define restart interval
             elif marker == 0xffdd:
                 length = stream.read_u16() - 2
-                stream.set_position(length, io.SEEK_CUR)
+                self.restart_interval = stream.read_u16()
+                stream.set_position(length - 2, io.SEEK_CUR)
 
-            # text comment
-            elif marker == 0xfffe:
+            # text comment; earlier versions of save() wrote comments as app15 markers
+            elif marker == 0xfffe or marker == 0xffef:
                 length = stream.read_u16() - 2
-                stream.set_position(length, io.SEEK_CUR)
+                comment = stream.read_u8_array(length)
+                # comments of only zeros are padding reserved by patch()
+                if any(comment):
+                    self.comments.append(comment)
 
             # start of scan marker
             elif marker == 0xffda:
                 length = stream.read_u16() - 2
                 self.scan_header = stream.read_u8_array(length)
                 # Assume this marker is the last marker except for the end of image marker
-                length = stream.get_length() - stream.get_position() - 2
-                self.scan_data = stream.read_u8_array(length)
+                self.scan_data_offset = stream.get_position()
+                self.scan_data_length = stream.get_length() - self.scan_data_offset - 2
+                if not metadata_only:
+                    self.scan_data = stream.read_u8_array(self.scan_data_length)
                 break
 
             # end of image marker
@@ -215,15 +687,319 @@ class JPEG:
             else:
                 raise ValueError
 
+            # Record the location of every segment before the start of scan so patch() can copy them unchanged
+            if marker != 0xffd8:
+                self.segments.append((marker, offset, stream.get_position() - offset))
+
     def get_image_time(self):
         return self.image_time
 
+    # Return the embedded JPEG thumbnail from the Exif IFD1 or a JFXX extension without decoding the image, or None
+    # When loaded with use_mmap the thumbnail is a view of the mapping rather than a copy
+    def get_thumbnail(self):
+        if self.exif_thumbnail is not None:
+            return self.exif_thumbnail
+        if self.jfxx_extension == 0x10:
+            return self.jfxx_thumbnail
+        return None
+
+    # Build an index of the entropy coded segment of every scan, including the scans of progressive files that follow
+    # the first scan, and return it as a list of JPEGScan
+    def index_scans(self):
+        self.scans = list(self.iter_scans())
+        return self.scans
+
+    # Yield a JPEGScan for each scan in turn; the scan data is only searched as far as the scans that are consumed
+    # data defaults to the scan data and can be any buffer holding it, such as a view of a memory mapped file
+    # If stop is set it is called with the header of each scan before its data is searched, and iteration ends without
+    # searching that scan if it returns True
+    def iter_scans(self, data=None, stop=None):
+        if data is None:
+            data = self.get_scan_data()
+            if data is None:
+                return
+
+        # Search the mapping directly if the scan data is a view of a memory mapped file
+        if isinstance(data, memoryview) and hasattr(data.obj, 'find'):
+            buffer, start, base = data.obj, self.scan_data_offset, 0
+        else:
+            buffer, start, base = data, 0, self.scan_data_offset
+        end = start + len(data)
+
+        header = self.scan_header
+        restart_interval = self.restart_interval
+        tables = []
+        position = start
+        while header is not None:
+            if stop is not None and stop(header):
+                return
+            scan = JPEGScan(header, base + position, restart_interval)
+            scan.tables = tables
+
+            # Within an entropy coded segment 0xff can only be followed by a stuffed zero, a restart marker or fill
+            index = buffer.find(b'\xff', position, end)
+            while 0 <= index < end - 1:
+                code = buffer[index + 1]
+                if code == 0x00:
+                    scan.stuffing_offsets.append(base + index)
+                    index = buffer.find(b'\xff', index + 2, end)
+                elif 0xd0 <= code <= 0xd7:
+                    scan.restart_offsets.append(base + index)
+                    index = buffer.find(b'\xff', index + 2, end)
+                elif code == 0xff:
+                    index += 1
+                else:
+                    break
+            position = index if 0 <= index < end - 1 else end
+            scan.length = base + position - scan.offset
+            yield scan
+
+            # Parse the table and restart interval markers that can precede the next scan
+            header = None
+            tables = []
+            while position + 4 <= end:
+                marker = int.from_bytes(buffer[position:position + 2], 'big')
+                if marker == 0xffd9:
+                    break
+                length = int.from_bytes(buffer[position + 2:position + 4], 'big')
+                if marker == 0xffda:
+                    header = bytes(buffer[position + 4:position + 2 + length])
+                    position += 2 + length
+                    break
+                elif marker == 0xffdd:
+                    restart_interval = int.from_bytes(buffer[position + 4:position + 6], 'big')
+                elif marker == 0xffc4 or marker == 0xffdb:
+                    tables.append((marker, table_cache.intern(buffer[position + 4:position + 2 + length])))
+                position += 2 + length
+
+    # Parse the frame header; returns the sample precision, image height and width and a list of JPEGComponent
+    def parse_frame(self):
+        frame = self.frame_start
+        precision = frame[0]
+        height = (frame[1] << 8) | frame[2]
+        width = (frame[3] << 8) | frame[4]
+        components = []
+        for i in range(frame[5]):
+            sampling = frame[7 + i * 3]
+            components.append(JPEGComponent(frame[6 + i * 3], sampling >> 4, sampling & 0x0f, frame[8 + i * 3]))
+        return precision, height, width, components
+
+    # Decode the quantized DCT coefficients of every block of a baseline (sequential Huffman) image into
+    # self.components; returns the list of JPEGComponent
+    # If max_workers is set then the restart intervals of scans that have them are decoded in batches on a pool of that
+    # many processes, as each interval is independent; scans without restart intervals are decoded in this process. On
+    # platforms that spawn processes the caller's main module must be safe to import
+    def decode_coefficients(self, max_workers=None):
+        if self.frame_type != 0xffc0:
+            raise ValueError("Only baseline JPEG images can be decoded")
+        precision, height, width, components = self.parse_frame()
+        set_block_dimensions(components, width, height)
+        for component in components:
+            component.coefficients = array.array('h', bytes(component.blocks_wide * component.blocks_high * 128))
+
+        huffman_tables = {}
+        for table in self.huffman_tables:
+            for table_class, table_id, huffman_table in table_cache.get(parse_huffman_tables, table):
+                huffman_tables[(table_class, table_id)] = huffman_table
+
+        data = self.get_scan_data()
+        executor = None
+        try:
+            for scan in self.index_scans():
+                for marker, table in scan.tables:
+                    if marker == 0xffc4:
+                        for table_class, table_id, huffman_table in table_cache.get(parse_huffman_tables, table):
+                            huffman_tables[(table_class, table_id)] = huffman_table
+
+                blocks, blocks_per_mcu = list_scan_blocks(scan.header, components, huffman_tables, width, height, 64)
+                num_components = scan.header[0]
+
+                # Each restart interval is decoded independently
+                interval_blocks = scan.restart_interval * blocks_per_mcu if scan.restart_interval else len(blocks)
+                intervals = []
+                for i, (offset, length) in enumerate(scan.get_intervals()):
+                    start = offset - self.scan_data_offset
+                    interval_data = bytes(data[start:start + length]).replace(b'\xff\x00', b'\xff')
+                    intervals.append((interval_data, blocks[i * interval_blocks:(i + 1) * interval_blocks]))
+
+                if max_workers is None or len(intervals) < 2:
+                    for interval_data, interval in intervals:
+                        decode_sequential_blocks(interval_data, interval, num_components)
+                    continue
+
+                # Give each worker a few batches of intervals and copy the coefficients returned into the components
+                if executor is None:
+                    executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+                pattern = [block[2:] for block in blocks[:blocks_per_mcu]]
+                batch_size = -(-len(intervals) // (max_workers * 4))
+                batches = [intervals[i:i + batch_size] for i in range(0, len(intervals), batch_size)]
+                futures = []
+                for batch in batches:
+                    batch_data = [(interval_data, len(interval)) for interval_data, interval in batch]
+                    futures.append(executor.submit(decode_sequential_intervals, batch_data, pattern, num_components))
+                for batch, future in zip(batches, futures):
+                    values = future.result()
+                    position = 0
+                    for interval_data, interval in batch:
+                        for coefficients, offset, dc_table, ac_table, index in interval:
+                            coefficients[offset:offset + 64] = values[position:position + 64]
+                            position += 64
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        self.components = components
+        return components
+
+    # Decode a baseline image to pixels; returns a NumPy uint8 array of shape (height, width, 3) for YCbCr images, or
+    # (height, width) for grayscale and (height, width, components) for other images
+    # This is not fast: nearly all of the time is the pure Python Huffman decode, which runs at about 2 megapixels a
+    # second for a detailed photo and a few times that for smooth images, so a 12 megapixel photo takes from one or two
+    # to six or more seconds on one core; the NumPy IDCT and colour conversion add well under a second. max_workers is
+    # passed to decode_coefficients and only helps images with restart intervals
+    def get_pixels(self, max_workers=None):
+        if numpy is None:
+            raise ImportError("NumPy is required to decode JPEG pixels")
+        components = self.decode_coefficients(max_workers)
+        precision, height, width, _ = self.parse_frame()
+
+        quantization_tables = self.get_quantization_tables(self.scans)
+
+        # The separable IDCT pixels = C^T . coefficients . C is done for every block at once as two batched 8x8 products
+        scale = numpy.full(8, 0.5)
+        scale[0] = numpy.sqrt(0.125)
+        basis = scale[:, None] * numpy.cos((2 * numpy.arange(8)[None, :] + 1) * numpy.arange(8)[:, None] * numpy.pi / 16)
+        basis = basis.astype(numpy.float32)
+        basis_transpose = numpy.ascontiguousarray(basis.T)
+        h_max = max(component.h for component in components)
+        v_max = max(component.v for component in components)
+        planes = []
+        for component in components:
+            blocks = component.get_blocks(True).reshape(-1, 64).astype(numpy.float32)
+            blocks *= numpy.array(quantization_tables[component.quantization_table_id], numpy.float32)
+            blocks[:, 0] += 8 << (precision - 1)        # level shift, as every DC basis value is 1/8
+            blocks = numpy.matmul(numpy.matmul(basis_transpose, blocks.reshape(-1, 8, 8)), basis)
+            plane = blocks.reshape(component.blocks_high, component.blocks_wide, 8, 8).transpose(0, 2, 1, 3)
+            plane = plane.reshape(component.blocks_high * 8, component.blocks_wide * 8)
+            plane = upsample(plane, v_max // component.v, 0)
+            plane = upsample(plane, h_max // component.h, 1)
+            planes.append(plane)
+
+        return convert_planes(planes, width, height, precision)
+
+    # Decode a 1/8 scale preview from the DC coefficients alone; returns a NumPy array shaped like get_pixels()
+    # For progressive images decoding stops at the first AC scan once every component has its DC coefficients, so the
+    # AC scans that follow are not read when the file was loaded with metadata_only set; AC scans that precede a DC
+    # scan are searched for their end but not decoded
+    def get_preview(self):
+        if numpy is None:
+            raise ImportError("NumPy is required to decode JPEG pixels")
+        if self.frame_type != 0xffc2:
+            components = self.decode_coefficients()
+            precision, height, width, _ = self.parse_frame()
+            for component in components:
+                component.coefficients = component.coefficients[0::64]
+            scans = self.scans
+        else:
+            precision, height, width, components = self.parse_frame()
+            scans = self.decode_dc_coefficients(components, width, height)
+        quantization_tables = self.get_quantization_tables(scans)
+
+        h_max = max(component.h for component in components)
+        v_max = max(component.v for component in components)
+        planes = []
+        for component in components:
+            plane = numpy.frombuffer(component.coefficients, numpy.int16).astype(numpy.float32)
+            plane = plane.reshape(component.blocks_high, component.blocks_wide)
+            plane *= numpy.float32(quantization_tables[component.quantization_table_id][0] / 8)
+            plane += numpy.float32(1 << (precision - 1))
+            plane = upsample(plane, v_max // component.v, 0)
+            plane = upsample(plane, h_max // component.h, 1)
+            planes.append(plane)
+        return convert_planes(planes, (width + 7) // 8, (height + 7) // 8, precision)
+
+    # Decode the DC coefficients of a progressive image into one coefficient per block of each component, stopping at
+    # the first AC scan after every component has its first DC scan; returns the scans that were decoded
+    def decode_dc_coefficients(self, components, width, height):
+        set_block_dimensions(components, width, height)
+        for component in components:
+            component.coefficients = array.array('h', bytes(component.blocks_wide * component.blocks_high * 2))
+
+        huffman_tables = {}
+        for table in self.huffman_tables:
+            for table_class, table_id, huffman_table in table_cache.get(parse_huffman_tables, table):
+                huffman_tables[(table_class, table_id)] = huffman_table
+
+        # Map the file rather than reading the scan data if it was not read when loading
+        stream = None
+        data = self.scan_data
+        if data is None:
+            stream = MmapStream(self.file_path, MmapStream.BIG_ENDIAN)
+            stream.set_position(self.scan_data_offset)
+            data = stream.read_u8_array(self.scan_data_length)
+
+        # Stop before searching the data of the first AC scan once every component has its DC coefficients
+        scans = []
+        decoded = set()
+        try:
+            for scan in self.iter_scans(data, lambda header: header[1 + header[0] * 2] != 0 and
+                                        len(decoded) == len(components)):
+                for marker, table in scan.tables:
+                    if marker == 0xffc4:
+                        for table_class, table_id, huffman_table in table_cache.get(parse_huffman_tables, table):
+                            huffman_tables[(table_class, table_id)] = huffman_table
+                header = scan.header
+                num_components = header[0]
+                spectral_start = header[1 + num_components * 2]
+                approximation = header[3 + num_components * 2]
+                if spectral_start != 0:
+                    continue
+                scans.append(scan)
+
+                blocks, blocks_per_mcu = list_scan_blocks(header, components, huffman_tables, width, height, 1)
+                interval_blocks = scan.restart_interval * blocks_per_mcu if scan.restart_interval else len(blocks)
+                for i, (offset, length) in enumerate(scan.get_intervals()):
+                    start = offset - self.scan_data_offset
+                    interval_data = bytes(data[start:start + length]).replace(b'\xff\x00', b'\xff')
+                    decode_dc_blocks(interval_data, blocks[i * interval_blocks:(i + 1) * interval_blocks],
+                                     num_components, approximation & 0x0f, approximation >> 4)
+                for i in range(num_components):
+                    decoded.add(header[1 + i * 2])
+        finally:
+            # Release the mapping even if the scan data is invalid
+            if stream is not None:
+                data.release()
+                stream.close()
+        return scans
+
+    # Return the quantization tables in natural order by table id, including tables defined between the given scans
+    def get_quantization_tables(self, scans):
+        quantization_tables = {}
+        for table in self.quantization_tables:
+            for table_id, values in table_cache.get(parse_quantization_tables, table):
+                quantization_tables[table_id] = values
+        for scan in scans:
+            for marker, table in scan.tables:
+                if marker == 0xffdb:
+                    for table_id, values in table_cache.get(parse_quantization_tables, table):
+                        quantization_tables[table_id] = values
+        return quantization_tables
+
+    # Return the entropy coded scan data, reading it from the file if it was not read when loading
+    def get_scan_data(self):
+        if self.scan_data is None and self.scan_data_length > 0:
+            stream = FileStream(self.file_path, 'rb', FileStream.BIG_ENDIAN)
+            stream.set_position(self.scan_data_offset)
+            self.scan_data = stream.read_u8_array(self.scan_data_length)
+            stream.close()
+        return self.scan_data
+
     def get_source_checksum(self):
         # Retrieve the source checksum from a comment marker
         source_checksum = None
         for comment in self.comments:
             if len(comment) == 8:
-                comment_value = struct.unpack('>Q', str(comment))[0]
+                comment_value = struct.unpack('>Q', bytes(comment))[0]
                 if (comment_value >> 32) == 0x53435243:                 # 'SCRC'
                     source_checksum = comment_value & 0xffffffff
         return source_checksum
@@ -232,65 +1008,118 @@ class JPEG:
         # Store source image checksum in a comment marker
         comment_value = (0x53435243 << 32) + checksum           # 'SCRC' identifies comment as  'Source CRC checksum'
         comment_bytes = bytearray(struct.pack('>Q', comment_value))
-        self.comments = [comment_bytes]
+        self.comments = [comment for comment in self.comments
+                         if len(comment) != 8 or bytes(comment[0:4]) != b'SCRC'] + [comment_bytes]
+
+    # Rewrite the segments before the start of scan in the loaded file, replacing its comments with self.comments and
+    # keeping every other segment byte for byte. If the new segments fit in the space of the old ones the file is
+    # updated in place, with any space left over filled by a padding comment; otherwise the file is rewritten with
+    # reserve bytes of padding and the scan data is copied without being read. Returns True if updated in place
+    def patch(self, reserve=0):
+        if self.scan_header is None:
+            raise ValueError("The file was not loaded as far as the start of scan")
+        sos_offset = self.scan_data_offset - len(self.scan_header) - 4
+        with FileStream(self.file_path, 'rb') as stream:
+            header = stream.read_u8_array(sos_offset)
+            file_length = stream.get_length()
+
+        # Comments replace the first existing comment, or follow the application segments at the start of the file
+        comments = b''.join(struct.pack('>HH', 0xfffe, len(comment) + 2) + bytes(comment) for comment in self.comments)
+        has_comments = any(marker == 0xfffe or marker == 0xffef for marker, offset, length in self.segments)
+        new_header = bytearray(b'\xff\xd8')
+        for marker, offset, length in self.segments:
+            is_comment = marker == 0xfffe or marker == 0xffef
+            if comments is not None and (is_comment if has_comments else not 0xffe0 <= marker <= 0xffef):
+                new_header += comments
+                comments = None
+            if not is_comment:
+                new_header += header[offset:offset + length]
+        if comments is not None:
+            new_header += comments
+
+        # Padding needs at least the four bytes of an empty comment segment
+        padding = sos_offset - len(new_header)
+        in_place = padding == 0 or 4 <= padding <= 0xffff + 2
+        if in_place:
+            if padding:
+                new_header += struct.pack('>HH', 0xfffe, padding - 2) + bytes(padding - 4)
+            with FileStream(self.file_path, 'r+b') as stream:
+                stream.write_u8_array(new_header)
+        else:
+            if reserve:
+                reserve = min(max(reserve, 4), 0xffff + 2)
+                new_header += struct.pack('>HH', 0xfffe, reserve - 2) + bytes(reserve - 4)
+            with FileStream(self.file_path, 'wb', FileStream.BIG_ENDIAN, atomic=True) as stream:
+                stream.write_u8_array(new_header)
+                stream.write_file_range(self.file_path, sos_offset, file_length - sos_offset)
+
+        # Update the segment index and the scan data location to match the new file
+        self.segments = []
+        offset = 2
+        while offset < len(new_header):
+            marker, length = struct.unpack_from('>HH', new_header, offset)
+            self.segments.append((marker, offset, length + 2))
+            offset += length + 2
+        self.scan_data_offset += len(new_header) - sos_offset
+        self.scans = []
+        if not in_place:
+            # Loaded scan data may be a view of the old file's mapping; it is read again from the new file if needed
+            self.scan_data = None
+        return in_place
 
     def save(self, file_path):
         self.file_path = file_path
-        stream = ByteStream(ByteStream.BIG_ENDIAN)
-
-        # Write start of image marker
-        stream.write_u16(0xffd8)
-
-        # Write JFIF-APP0 marker
-        stream.write_u16(0xffe0)          # jfif marker
-        stream.write_u16(16)              # marker length
-        stream.write_u32(0x4a464946)        # jfif-app0 identifier
-        stream.write_u8(0)                # identifier terminator
-        stream.write_u16(self.jfif_version)
-        stream.write_u8(self.density_units)
-        stream.write_u16(self.x_density)
-        stream.write_u16(self.y_density)
-        stream.write_u8(self.x_thumbnail)
-        stream.write_u8(self.y_thumbnail)
-        stream.write_u8_array(self.thumbnail_image)
-
-        # Write Exif marker
-        if self.exif:
-            stream.write_u16(0xffe1)
-            stream.write_u16(len(self.exif) + 2)
-            stream.write_u8_array(self.exif)
-
-        # Write comments
-        for comment in self.comments:
-            stream.write_u16(0xffef)
-            stream.write_u16(len(comment) + 2)
-            stream.write_u8_array(comment)
-
-        # Write quantization tables
-        for quant_table in self.quantization_tables:
-            stream.write_u16(0xffdb)
-            stream.write_u16(len(quant_table) + 2)
-            stream.write_u8_array(quant_table)
-
-        # Write frame start
-        stream.write_u16(0xffc0)
-        stream.write_u16(len(self.frame_start) + 2)
-        stream.write_u8_array(self.frame_start)
-
-        # Write huffman tables
-        for huff_table in self.huffman_tables:
-            stream.write_u16(0xffc4)
-            stream.write_u16(len(huff_table) + 2)
-            stream.write_u8_array(huff_table)
-
-        # Write scan data
-        stream.write_u16(0xffda)
-        stream.write_u16(len(self.scan_header) + 2)
-        stream.write_u8_array(self.scan_header)
-        stream.write_u8_array(self.scan_data)
-
-        # Write end of image
-        stream.write_u16(0xffd9)
-
-        with open(self.file_path, 'wb') as f:
-            f.write(stream.get_data())
+        with FileStream(self.file_path, 'wb', FileStream.BIG_ENDIAN, atomic=True) as stream:
+            # Write start of image marker
+            stream.write_u16(0xffd8)
+
+            # Write JFIF-APP0 marker
+            stream.write_u16(0xffe0)          # jfif marker
+            stream.write_u16(16)              # marker length
+            stream.write_u32(0x4a464946)        # jfif-app0 identifier
+            stream.write_u8(0)                # identifier terminator
+            stream.write_u16(self.jfif_version)
+            stream.write_u8(self.density_units)
+            stream.write_u16(self.x_density)
+            stream.write_u16(self.y_density)
+            stream.write_u8(self.x_thumbnail)
+            stream.write_u8(self.y_thumbnail)
+            stream.write_u8_array(self.thumbnail_image)
+
+            # Write Exif marker
+            if self.exif:
+                stream.write_u16(0xffe1)
+                stream.write_u16(len(self.exif) + 2)
+                stream.write_u8_array(self.exif)
+
+            # Write comments
+            for comment in self.comments:
+                stream.write_u16(0xfffe)
+                stream.write_u16(len(comment) + 2)
+                stream.write_u8_array(comment)
+
+            # Write quantization tables
+            for quant_table in self.quantization_tables:
+                stream.write_u16(0xffdb)
+                stream.write_u16(len(quant_table) + 2)
+                stream.write_u8_array(quant_table)
+
+            # Write frame start
+            stream.write_u16(self.frame_type if self.frame_type else 0xffc0)
+            stream.write_u16(len(self.frame_start) + 2)
+            stream.write_u8_array(self.frame_start)
+
+            # Write huffman tables
+            for huff_table in self.huffman_tables:
+                stream.write_u16(0xffc4)
+                stream.write_u16(len(huff_table) + 2)
+                stream.write_u8_array(huff_table)
+
+            # Write scan data
+            stream.write_u16(0xffda)
+            stream.write_u16(len(self.scan_header) + 2)
+            stream.write_u8_array(self.scan_header)
+            stream.write_u8_array(self.get_scan_data())
+
+            # Write end of image
+            stream.write_u16(0xffd9)
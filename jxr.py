@@ -3,7 +3,7 @@
 # For JXR format see https://www.itu.int/rec/T-REC-T.832-201906-I/en
 
 import io
-from streams import ByteStream, FileStream
+from streams import AsyncStream, FileStream, MmapStream
 
 pixel_formats = {
     0x05: 'BlackWhite',
@@ -97,23 +97,59 @@ class JXR:
         self.image_offset = 0
         self.image_byte_count = 0
         self.image_data = None
+        self.payload_range = None
         self.source_checksum = 0
 
-    def load(self, file_path):
+    # If use_mmap is set then the file is memory mapped and the image data is a view of the mapping
+    # If read_payload is not set then the image data is not read; save() copies it from this file instead
+    def load(self, file_path, use_mmap=False, read_payload=True):
         self.file_path = file_path
-        stream = FileStream(self.file_path, 'rb')
-        identifier = stream.read_u32()
+        if use_mmap:
+            stream = MmapStream(self.file_path)
+        else:
+            stream = FileStream(self.file_path, 'rb', read_ahead=FileStream.DEFAULT_READ_AHEAD)
+        self.load_stream(stream, read_payload)
+
+    # Load from an asyncio.StreamReader or a file path without blocking the event loop
+    # The IFDs and the values before the image data are held and the image data is skipped, as when read_payload is not
+    # set; an IFD that follows the image data is reached by holding the image data up to AsyncStream.max_length
+    async def load_async(self, source):
+        stream = AsyncStream(source)
+        if await stream.fill(8) == 8:
+            stream.set_position(4)
+            next_ifd_offset = stream.read_u32()
+            visited_ifds = set()
+            image_offset = None
+            while next_ifd_offset != 0 and next_ifd_offset not in visited_ifds:
+                visited_ifds.add(next_ifd_offset)
+                await stream.fill_to(next_ifd_offset + 2)
+                stream.set_position(next_ifd_offset)
+                num_entries = stream.read_u16()
+                await stream.fill_to(stream.get_position() + num_entries * 12 + 4)
+                for i in range(num_entries):
+                    field_tag, element_type, num_elements, value = stream.read_struct('HHII')
+                    if field_tag == 0xbcc0:
+                        # Values of less than 4 bytes are in the low bytes of the little endian value field
+                        element_size = [0, 1, 1, 2][element_type] if element_type < 4 else 4
+                        image_offset = value & ((1 << (element_size * 8)) - 1)
+                next_ifd_offset = stream.read_u32()
+            if image_offset is not None:
+                await stream.fill_to(image_offset)
+            await stream.skip()
+            stream.set_position(0)
+        self.file_path = stream.file_name
+        self.load_stream(stream, read_payload=False)
+
+    def load_stream(self, stream, read_payload=True):
+        identifier, next_ifd_offset = stream.read_struct('II')
         if identifier != 0x01bc4949:
             raise ValueError
 
-        next_ifd_offset = stream.read_u32()
         while next_ifd_offset != 0:
             stream.set_position(next_ifd_offset)
             num_entries = stream.read_u16()
             for i in range(num_entries):
-                field_tag = stream.read_u16()
-                element_type = stream.read_u16()
-                num_elements = stream.read_u32()
+                field_tag, element_type, num_elements = stream.read_struct('HHI')
                 element_type_size = [0, 1, 1, 2, 4, 8, 1, 1, 2, 4, 8, 4, 8][element_type]
                 element_size = element_type_size * num_elements
 
@@ -137,8 +173,12 @@ class JXR:
                     stream.set_position(element_size, io.SEEK_CUR)
             next_ifd_offset = stream.read_u32()
 
-        stream.set_position(self.image_offset)
-        self.image_data = stream.read_u8_array(self.image_byte_count)
+        if read_payload:
+            stream.set_position(self.image_offset)
+            self.image_data = stream.read_u8_array(self.image_byte_count)
+        else:
+            self.image_data = None
+            self.payload_range = (self.file_path, self.image_offset, self.image_byte_count)
 
     @staticmethod
     def __read_element(stream, element_size):
@@ -168,56 +208,55 @@ class JXR:
         self.source_checksum = checksum
 
     def save(self):
-        stream = ByteStream()
-
-        # Write header
-        stream.write_u32(0x01bc4949)            # file identifier
-        stream.write_u32(0x00000008)            # offset to IFD table
-
-        # Write IFD table
-        ifd_length = 2 + (12 * 6) + 4
+        with FileStream(self.file_path, 'wb', atomic=True) as stream:
+            # Write header
+            stream.write_u32(0x01bc4949)            # file identifier
+            stream.write_u32(0x00000008)            # offset to IFD table
 
-        stream.write_u16(6)                   # IFD table contains 6 entries
+            # Write IFD table
+            ifd_length = 2 + (12 * 6) + 4
 
-        stream.write_u16(0xbc01)              # pixel format
-        stream.write_u16(0x01)                # BYTE type
-        stream.write_u32(0x10)                  # pixel format consists of 16 bytes
-        stream.write_u32(8 + ifd_length)        # pixel format bytes follow header and ifd table
+            stream.write_u16(6)                   # IFD table contains 6 entries
 
-        stream.write_u16(0xbc80)              # image width
-        stream.write_u16(0x04)                # ULONG type
-        stream.write_u32(0x01)                  # one element
-        stream.write_u32(self.image_width)
+            stream.write_u16(0xbc01)              # pixel format
+            stream.write_u16(0x01)                # BYTE type
+            stream.write_u32(0x10)                  # pixel format consists of 16 bytes
+            stream.write_u32(8 + ifd_length)        # pixel format bytes follow header and ifd table
 
-        stream.write_u16(0xbc81)              # image height
-        stream.write_u16(0x04)                # ULONG type
-        stream.write_u32(0x01)                  # one element
-        stream.write_u32(self.image_height)
+            stream.write_u16(0xbc80)              # image width
+            stream.write_u16(0x04)                # ULONG type
+            stream.write_u32(0x01)                  # one element
+            stream.write_u32(self.image_width)
 
-        stream.write_u16(0xbcc0)              # image offset
-        stream.write_u16(0x04)                # ULONG type
-        stream.write_u32(0x01)                  # one element
-        stream.write_u32(8 + ifd_length + 16)   # image data follows header, ifd table, and pixel format
+            stream.write_u16(0xbc81)              # image height
+            stream.write_u16(0x04)                # ULONG type
+            stream.write_u32(0x01)                  # one element
+            stream.write_u32(self.image_height)
 
-        stream.write_u16(0xbcc1)              # image byte count
-        stream.write_u16(0x04)                # ULONG type
-        stream.write_u32(0x01)                  # one element
-        stream.write_u32(self.image_byte_count)
+            stream.write_u16(0xbcc0)              # image offset
+            stream.write_u16(0x04)                # ULONG type
+            stream.write_u32(0x01)                  # one element
+            stream.write_u32(8 + ifd_length + 16)   # image data follows header, ifd table, and pixel format
 
-        # custom tag holding source image checksum
-        stream.write_u16(0xcfc5)              # custom tag for source image checksum
-        stream.write_u16(0x01)                # BYTE type
-        stream.write_u32(0x04)                  # contains 4 bytes
-        stream.write_u32(self.source_checksum)
+            stream.write_u16(0xbcc1)              # image byte count
+            stream.write_u16(0x04)                # ULONG type
+            stream.write_u32(0x01)                  # one element
+            stream.write_u32(self.image_byte_count)
 
-        stream.write_u32(0)                     # IFD terminator
+            # custom tag holding source image checksum
+            stream.write_u16(0xcfc5)              # custom tag for source image checksum
+            stream.write_u16(0x01)                # BYTE type
+            stream.write_u32(0x04)                  # contains 4 bytes
+            stream.write_u32(self.source_checksum)
 
-        # write pixel format bytes
-        stream.write_u8_array(bytearray([0x24, 0xC3, 0xDD, 0x6F, 0x03, 0x4E, 0xFE, 0x4B, 0xB1, 0x85, 0x3D, 0x77, 0x76, 0x8D, 0xC9]))
-        stream.write_u8(self.pixel_format)
+            stream.write_u32(0)                     # IFD terminator
 
-        # write image data
-        stream.write_u8_array(self.image_data)
+            # write pixel format bytes
+            stream.write_u8_array(bytearray([0x24, 0xC3, 0xDD, 0x6F, 0x03, 0x4E, 0xFE, 0x4B, 0xB1, 0x85, 0x3D, 0x77, 0x76, 0x8D, 0xC9]))
+            stream.write_u8(self.pixel_format)
 
-        with open(self.file_path, 'wb') as f:
-            f.write(stream.get_data())
+            # write image data
+            if self.image_data is None:
+                stream.write_file_range(*self.payload_range)
+            else:
+                stream.write_u8_array(self.image_data)
@@ -4,7 +4,7 @@
 
 import io
 import struct
-from streams import ByteStream, FileStream
+from streams import AsyncStream, FileStream, MmapStream
 
 pixel_format_names = {
     0x8C92: 'ATC_RGB',
@@ -39,30 +39,42 @@ class KTX:
         self.metadata = {}
         self.source_checksum = 0
         self.mip_images = []
+        self.payload_range = None
 
-    def load(self, file_path):
+    # If use_mmap is set then the file is memory mapped and mip images are views of the mapping
+    # If read_payload is not set then the mip images are not read; save() copies them from this file instead
+    def load(self, file_path, use_mmap=False, read_payload=True):
         self.file_path = file_path
-        stream = FileStream(self.file_path, "rb")
-
+        if use_mmap:
+            stream = MmapStream(self.file_path)
+        else:
+            stream = FileStream(self.file_path, "rb", read_ahead=FileStream.DEFAULT_READ_AHEAD)
+        self.load_stream(stream, read_payload)
+
+    # Load from an asyncio.StreamReader or a file path without blocking the event loop
+    # The header and metadata are held and the mip images are skipped, as when read_payload is not set
+    async def load_async(self, source):
+        stream = AsyncStream(source)
+        if await stream.fill(64) == 64:
+            stream.set_position(12)
+            endianness = stream.read_u32()
+            stream.set_endian(FileStream.BIG_ENDIAN if endianness == 0x01020304 else FileStream.LITTLE_ENDIAN)
+            stream.set_position(60)
+            await stream.fill(stream.read_u32())
+            await stream.skip()
+            stream.set_position(0)
+            stream.set_endian(FileStream.LITTLE_ENDIAN)
+        self.file_path = stream.file_name
+        self.load_stream(stream, read_payload=False)
+
+    def load_stream(self, stream, read_payload=True):
         # parse header
-        self.identifier1 = stream.read_u32()
-        self.identifier2 = stream.read_u32()
-        self.identifier3 = stream.read_u32()
-        self.endianness = stream.read_u32()
+        self.identifier1, self.identifier2, self.identifier3, self.endianness = stream.read_struct('4I')
         if self.endianness == 0x01020304:
             stream.set_endian(FileStream.BIG_ENDIAN)
-        self.gl_type = stream.read_u32()
-        self.gl_type_size = stream.read_u32()
-        self.gl_format = stream.read_u32()
-        self.gl_internal_format = stream.read_u32()
-        self.gl_base_internal_format = stream.read_u32()
-        self.pixel_width = stream.read_u32()
-        self.pixel_height = stream.read_u32()
-        self.pixel_depth = stream.read_u32()
-        self.num_array_elements = stream.read_u32()
-        self.num_faces = stream.read_u32()
-        self.num_mipmaps = stream.read_u32()
-        self.metadata_size = stream.read_u32()
+        (self.gl_type, self.gl_type_size, self.gl_format, self.gl_internal_format, self.gl_base_internal_format,
+         self.pixel_width, self.pixel_height, self.pixel_depth, self.num_array_elements, self.num_faces,
+         self.num_mipmaps, self.metadata_size) = stream.read_struct('12I')
 
         # parse metadata
         metadata_end = stream.get_position() + self.metadata_size
@@ -71,24 +83,19 @@ class KTX:
             kv_pair_size = stream.read_u32()
             kv_pair_end = stream.get_position() + kv_pair_size
 
-            # read key name
-            key = ''
-            char = stream.read_u8()
-            while char != 0:
-                key += chr(char)
-                char = stream.read_u8()
-
-            # read value
-            value = bytearray()
-            while stream.get_position() < kv_pair_end:
-                byte = stream.read_u8()
-                value.append(byte)
+            # read key name and value
+            key = stream.read_nt_string()
+            value = stream.read_u8_array(kv_pair_end - stream.get_position())
 
             padding_length = 3 - ((kv_pair_size + 3) % 4)
             stream.set_position(padding_length, io.SEEK_CUR)
             self.metadata[key] = value
 
         # parse image data
+        if not read_payload:
+            # mip images, including their size fields, run from here to the end of the file
+            self.payload_range = (self.file_path, stream.get_position(), stream.get_length() - stream.get_position())
+            return
         for mip_level in range(self.num_mipmaps):
             mip_size = stream.read_u32()
             mip_size = (mip_size + 3) & -4
@@ -118,42 +125,40 @@ class KTX:
         self.metadata['SCRC'] = bytearray(struct.pack("<I", checksum))
 
     def save(self):
-        stream = ByteStream(ByteStream.LITTLE_ENDIAN)
-
-        # write header
-        stream.write_u32(self.identifier1)
-        stream.write_u32(self.identifier2)
-        stream.write_u32(self.identifier3)
-        stream.write_u32(self.endianness)
-        stream.write_u32(self.gl_type)
-        stream.write_u32(self.gl_type_size)
-        stream.write_u32(self.gl_format)
-        stream.write_u32(self.gl_internal_format)
-        stream.write_u32(self.gl_base_internal_format)
-        stream.write_u32(self.pixel_width)
-        stream.write_u32(self.pixel_height)
-        stream.write_u32(self.pixel_depth)
-        stream.write_u32(self.num_array_elements)
-        stream.write_u32(self.num_faces)
-        stream.write_u32(self.num_mipmaps)
-        stream.write_u32(self.metadata_size)
-
-        # write metadata
-        for key in self.metadata:
-            value = self.metadata[key]
-            length = len(key) + 1 + len(value)
-            stream.write_u32(length)
-            stream.write_string(key)
-            stream.write_u8(0)
-            stream.write_u8_array(value)
-            padding = 3 - ((length + 3) % 4)
-            for i in range(padding):
+        with FileStream(self.file_path, "wb", FileStream.LITTLE_ENDIAN, atomic=True) as stream:
+            # write header
+            stream.write_u32(self.identifier1)
+            stream.write_u32(self.identifier2)
+            stream.write_u32(self.identifier3)
+            stream.write_u32(self.endianness)
+            stream.write_u32(self.gl_type)
+            stream.write_u32(self.gl_type_size)
+            stream.write_u32(self.gl_format)
+            stream.write_u32(self.gl_internal_format)
+            stream.write_u32(self.gl_base_internal_format)
+            stream.write_u32(self.pixel_width)
+            stream.write_u32(self.pixel_height)
+            stream.write_u32(self.pixel_depth)
+            stream.write_u32(self.num_array_elements)
+            stream.write_u32(self.num_faces)
+            stream.write_u32(self.num_mipmaps)
+            stream.write_u32(self.metadata_size)
+
+            # write metadata
+            for key in self.metadata:
+                value = self.metadata[key]
+                length = len(key) + 1 + len(value)
+                stream.write_u32(length)
+                stream.write_string(key)
                 stream.write_u8(0)
-
-        # write mip images
-        for mip_image in self.mip_images:
-            stream.write_u32(len(mip_image))
-            stream.write_u8_array(mip_image)
-
-        with open(self.file_path, "wb") as f:
-            f.write(stream.get_data())
+                stream.write_u8_array(value)
+                padding = 3 - ((length + 3) % 4)
+                for i in range(padding):
+                    stream.write_u8(0)
+
+            # write mip images
+            if self.payload_range is not None:
+                stream.write_file_range(*self.payload_range)
+            for mip_image in self.mip_images:
+                stream.write_u32(len(mip_image))
+                stream.write_u8_array(mip_image)
@@ -11,7 +11,7 @@
 import io
 import sys
 import datetime
-from streams import FileStream
+from streams import AsyncStream, FileStream
 from tiff import TIFF
 
 
@@ -24,7 +24,38 @@ class MP4:
 
     def load(self, url):
         self.url = url
-        self.stream = FileStream(url, 'rb', FileStream.BIG_ENDIAN)
+        self.load_stream(FileStream(url, 'rb', FileStream.BIG_ENDIAN, FileStream.DEFAULT_READ_AHEAD))
+
+    # Load from an asyncio.StreamReader or a file path without blocking the event loop
+    # Media data is skipped rather than held, except in HEIF files where a top level 'meta' atom places items, such as
+    # the Exif data, in it
+    async def load_async(self, source):
+        stream = AsyncStream(source, AsyncStream.BIG_ENDIAN)
+        has_items = False
+        while await stream.fill(8) == 8:
+            stream.set_position(stream.get_length() - 8)
+            atom_size = stream.read_u32()
+            atom_type = stream.read_string(4)
+            header_size = 8
+            if atom_size == 1:
+                if await stream.fill(8) < 8:
+                    break
+                atom_size = stream.read_u64()
+                header_size = 16
+            remaining = atom_size - header_size if atom_size != 0 else -1
+            if remaining < 0 and atom_size != 0:
+                raise ValueError("Invalid atom size")
+            if atom_type in ('free', 'skip', 'wide') or (atom_type == 'mdat' and not has_items):
+                await stream.skip(remaining)
+            else:
+                await stream.fill(remaining)
+                has_items = has_items or atom_type == 'meta'
+        stream.set_position(0)
+        self.url = stream.file_name
+        self.load_stream(stream)
+
+    def load_stream(self, stream):
+        self.stream = stream
         self.parse(self.stream.get_length())
 
     # Parse one or more sequential atoms and try to locate image creation time
@@ -3,63 +3,229 @@
 # For PNG format see https://www.w3.org/TR/PNG/
 
 import io
+import sys
+import zlib
+import array
+import struct
 import datetime
-import xml.etree.ElementTree as ET
-from streams import FileStream
+from streams import AsyncStream, FileStream, U32_TYPECODE
+from xmp import find_properties
+
+
+class PNGChunkIndex:
+    """
+    Index of every chunk in a PNG file, held in parallel arrays: the chunk type as a big endian 32-bit value, the
+    file offset and length of the chunk data, and the stored CRC. Chunk data is not held; it is read on demand.
+    file_length is the length of the indexed file, used with the IHDR CRC to detect a changed file.
+    """
+
+    __slots__ = ('file_length', 'types', 'offsets', 'lengths', 'crcs')
+
+    # Serialized form: signature, chunk count and file length, followed by the arrays in little endian order
+    HEADER = struct.Struct('<4sIQ')
+    SIGNATURE = b'PNGI'
+
+    def __init__(self):
+        self.file_length = 0
+        self.types = array.array(U32_TYPECODE)
+        self.offsets = array.array('Q')
+        self.lengths = array.array(U32_TYPECODE)
+        self.crcs = array.array(U32_TYPECODE)
+
+    def __len__(self):
+        return len(self.types)
+
+    def append(self, type, offset, length, crc):
+        self.types.append(type)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.crcs.append(crc)
+
+    # Return the indices of the chunks of the given type, e.g. 'tEXt'
+    def find(self, type):
+        value = int.from_bytes(type.encode('latin_1'), 'big')
+        return [index for index, chunk_type in enumerate(self.types) if chunk_type == value]
+
+    def get_type(self, index):
+        return self.types[index].to_bytes(4, 'big').decode('latin_1')
+
+    def to_bytes(self):
+        arrays = (self.types, self.offsets, self.lengths, self.crcs)
+        if sys.byteorder != 'little':
+            arrays = [array.array(values.typecode, values) for values in arrays]
+            for values in arrays:
+                values.byteswap()
+        header = self.HEADER.pack(self.SIGNATURE, len(self.types), self.file_length)
+        return header + b''.join(values.tobytes() for values in arrays)
+
+    @staticmethod
+    def from_bytes(data):
+        index = PNGChunkIndex()
+        if len(data) < PNGChunkIndex.HEADER.size:
+            raise ValueError("PNG chunk index is truncated")
+        signature, count, index.file_length = PNGChunkIndex.HEADER.unpack_from(data)
+        if signature != PNGChunkIndex.SIGNATURE:
+            raise ValueError("Not a PNG chunk index")
+        position = PNGChunkIndex.HEADER.size
+        for values in (index.types, index.offsets, index.lengths, index.crcs):
+            length = count * values.itemsize
+            if position + length > len(data):
+                raise ValueError("PNG chunk index is truncated")
+            values.frombytes(data[position:position + length])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            position += length
+        return index
 
 
 class PNG:
     def __init__(self):
         self.file_path = None
+        self.stream = None
+        self.chunk_index = PNGChunkIndex()
         self.image_time = None
+        # XMP properties to extract into self.xmp when loading; callers can add their own before loading
+        self.xmp_property_names = ['photoshop:DateCreated']
+        self.xmp = {}
 
     def load(self, file_path):
         self.file_path = file_path
-        stream = FileStream(file_path, "rb", FileStream.BIG_ENDIAN)
+        stream = FileStream(file_path, "rb", FileStream.BIG_ENDIAN, FileStream.DEFAULT_READ_AHEAD)
+        self.load_stream(stream)
+
+    # Load from an asyncio.StreamReader or a file path without blocking the event loop
+    # Every chunk is held except the image data, which is skipped; IDAT chunks stay in the chunk index but their data
+    # is not held, so reading it raises ValueError
+    async def load_async(self, source):
+        stream = AsyncStream(source, AsyncStream.BIG_ENDIAN)
+        if await stream.fill(8) == 8:
+            while await stream.fill(8) == 8:
+                stream.set_position(stream.get_length() - 8)
+                length, type = stream.read_struct('II')
+                if type == 0x49444154:      # 'IDAT'
+                    await stream.skip(length)
+                    await stream.fill(4)
+                else:
+                    await stream.fill(length + 4)
+                if type == 0x49454e44:      # 'IEND'
+                    break
+            stream.set_position(0)
+        self.file_path = stream.file_name
+        self.load_stream(stream)
+
+    # Load from a chunk index previously returned by chunk_index.to_bytes() instead of scanning the file
+    # A ValueError is raised if the file length or IHDR CRC no longer match the index, as the file has changed
+    def load_index(self, file_path, index_data):
+        self.file_path = file_path
+        self.chunk_index = PNGChunkIndex.from_bytes(index_data)
+        self.stream = FileStream(file_path, "rb", FileStream.BIG_ENDIAN)
+        is_changed = self.stream.get_length() != self.chunk_index.file_length
+        indices = self.chunk_index.find("IHDR")
+        if indices and not is_changed:
+            index = indices[0]
+            self.stream.set_position(self.chunk_index.offsets[index] + self.chunk_index.lengths[index])
+            is_changed = self.stream.read_u32() != self.chunk_index.crcs[index]
+        if is_changed:
+            self.stream.close()
+            self.stream = None
+            raise ValueError("File has changed since the chunk index was made")
+        self.parse_metadata()
+
+    def load_stream(self, stream):
+        self.stream = stream
+        self.chunk_index = PNGChunkIndex()
+        self.chunk_index.file_length = stream.get_length()
         id1 = stream.read_u32()
         id2 = stream.read_u32()
         if id1 == 0x89504e47 and id2 == 0x0d0a1a0a:
+            # Index the chunks without reading their data
             while not stream.is_eof():
-                length = stream.read_u32()
-                type = stream.read_string(4)
-                if type == "tIME":
-                    year = stream.read_u16()
-                    month = stream.read_u8()
-                    day = stream.read_u8()
-                    hour = stream.read_u8()
-                    minute = stream.read_u8()
-                    second = stream.read_u8()
-                    self.image_time = datetime.datetime(year, month, day, hour, minute, second)
-                    crc = stream.read_u32()
-                elif type == "tEXt":                # text
-                    stream.set_position(length, io.SEEK_CUR)
-                    crc = stream.read_u32()
-                elif type == "zTXt":                # deflated text
-                    stream.set_position(length, io.SEEK_CUR)
-                    crc = stream.read_u32()
-                elif type == "iTXt":                # international text
-                    index = stream.get_position()
-                    keyword = stream.read_nt_string()
-                    compression_flag = stream.read_u8()
-                    compression_method = stream.read_u8()
-                    language_tag = stream.read_nt_string()
-                    translated_keyword = stream.read_nt_string()
-                    text_length = length - (stream.get_position() - index)
-                    text = stream.read_string(text_length)
-                    if keyword == "XML:com.adobe.xmp":
-                        xml_root = ET.fromstring(text)
-                        date_element = xml_root.find(".//{http://ns.adobe.com/photoshop/1.0/}DateCreated")
-                        if date_element is not None:
-                            try:
-                                self.image_time = datetime.datetime.strptime(date_element.text, "%Y-%m-%dT%H:%M:%S")
-                            except ValueError:
-                                pass
-                    crc = stream.read_u32()
-                elif type == "IEND":
+                length, type = stream.read_struct('II')
+                offset = stream.get_position()
+                stream.set_position(length, io.SEEK_CUR)
+                crc = stream.read_u32()
+                self.chunk_index.append(type, offset, length, crc)
+                if type == 0x49454e44:      # 'IEND'
                     break
-                else:
-                    stream.set_position(length, io.SEEK_CUR)
-                    crc = stream.read_u32()
+        self.parse_metadata()
+
+    # Set the image time and XMP properties from the tIME chunk and XMP iTXt chunk, whichever is later in the file
+    def parse_metadata(self):
+        for index in range(len(self.chunk_index)):
+            type = self.chunk_index.get_type(index)
+            if type == "tIME":
+                year, month, day, hour, minute, second = struct.unpack('>HBBBBB', self.read_chunk(index)[0:7])
+                self.image_time = datetime.datetime(year, month, day, hour, minute, second)
+            elif type == "iTXt":            # international text
+                keyword, text = self.parse_text(type, self.read_chunk(index))
+                if keyword == "XML:com.adobe.xmp":
+                    self.xmp.update(find_properties(text, self.xmp_property_names))
+                    if "photoshop:DateCreated" in self.xmp:
+                        try:
+                            self.image_time = datetime.datetime.strptime(self.xmp["photoshop:DateCreated"],
+                                                                         "%Y-%m-%dT%H:%M:%S")
+                        except ValueError:
+                            pass
+
+    # Read the data of the chunk at index in the chunk index; if check_crc is set then a ValueError is raised if the
+    # data does not match the stored CRC
+    def read_chunk(self, index, check_crc=False):
+        if self.stream is None:
+            self.stream = FileStream(self.file_path, "rb", FileStream.BIG_ENDIAN)
+        self.stream.set_position(self.chunk_index.offsets[index])
+        data = self.stream.read_u8_array(self.chunk_index.lengths[index])
+        if check_crc:
+            crc = zlib.crc32(data, zlib.crc32(self.chunk_index.types[index].to_bytes(4, 'big')))
+            if crc != self.chunk_index.crcs[index]:
+                raise ValueError("Chunk CRC does not match")
+        return data
+
+    # Return the data of the first chunk of the given type, e.g. 'iCCP', or None if there is no such chunk
+    def get_chunk(self, type, check_crc=False):
+        indices = self.chunk_index.find(type)
+        return self.read_chunk(indices[0], check_crc) if indices else None
+
+    # Return the data of every chunk of the given type
+    def get_chunks(self, type, check_crc=False):
+        return [self.read_chunk(index, check_crc) for index in self.chunk_index.find(type)]
+
+    # Split the data of a tEXt, zTXt or iTXt chunk into its keyword and uncompressed text bytes
+    @staticmethod
+    def parse_text(type, data):
+        data = bytes(data)
+        separator = data.index(b'\x00')
+        keyword = data[:separator].decode('latin_1')
+        if type == "tEXt":
+            text = data[separator + 1:]
+        elif type == "zTXt":
+            text = zlib.decompress(data[separator + 2:])
+        else:
+            compression_flag = data[separator + 1]
+            language_end = data.index(b'\x00', separator + 3)
+            translated_keyword_end = data.index(b'\x00', language_end + 1)
+            text = data[translated_keyword_end + 1:]
+            if compression_flag:
+                text = zlib.decompress(text)
+        return keyword, text
+
+    # Return a dict of keyword to text for the tEXt, zTXt and iTXt chunks
+    def get_text(self):
+        texts = {}
+        for index in range(len(self.chunk_index)):
+            type = self.chunk_index.get_type(index)
+            if type in ("tEXt", "zTXt", "iTXt"):
+                keyword, text = self.parse_text(type, self.read_chunk(index))
+                texts[keyword] = text.decode('utf-8' if type == "iTXt" else 'latin_1')
+        return texts
+
+    # Return the name and uncompressed data of the ICC profile, or None if there is no iCCP chunk
+    def get_icc_profile(self):
+        data = self.get_chunk("iCCP")
+        if data is None:
+            return None
+        data = bytes(data)
+        separator = data.index(b'\x00')
+        return data[:separator].decode('latin_1'), zlib.decompress(data[separator + 2:])
 
     def get_image_time(self):
         return self.image_time
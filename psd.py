@@ -2,8 +2,7 @@
 
 # For PSD format see https://www.adobe.com/devnet-apps/photoshop/fileformatashtml/
 
-import io
-from streams import FileStream
+from streams import AsyncStream, FileStream
 
 
 class PSD:
@@ -19,14 +18,17 @@ class PSD:
 
     def load(self):
         stream = FileStream(self.file_path, "rb", FileStream.BIG_ENDIAN)
-        self.signature = stream.read_u32()
-        self.version = stream.read_u16()
-        stream.set_position(6, io.SEEK_CUR)
-        self.num_channels = stream.read_u16()
-        self.height = stream.read_u32()
-        self.width = stream.read_u32()
-        self.depth = stream.read_u16()
-        self.color_mode = stream.read_u16()
+        self.load_stream(stream)
+
+    # Load from an asyncio.StreamReader, or from the file path without blocking the event loop
+    async def load_async(self, source=None):
+        stream = AsyncStream(source if source is not None else self.file_path, AsyncStream.BIG_ENDIAN)
+        await stream.fill(26)               # only the fixed size header is parsed
+        self.load_stream(stream)
+
+    def load_stream(self, stream):
+        (self.signature, self.version, self.num_channels, self.height, self.width, self.depth,
+         self.color_mode) = stream.read_struct('IH6xHIIHH')
 
     def get_width(self):
         return self.width
@@ -3,7 +3,7 @@
 # PVR file format: http://cdn.imgtec.com/sdk-documentation/PVR+File+Format.Specification.pdf
 
 import io
-from streams import ByteStream, FileStream
+from streams import AsyncStream, FileStream, MmapStream
 
 pixel_formats = {
     # Name, Bits per pixel, Min width, Min height
@@ -87,6 +87,7 @@ class PVR:
         self.metadata_size = 0
         self.image_data_size = 0
         self.image_data = 0
+        self.payload_range = None
         self.source_checksum = None
         self.meta_texture_atlas = None
         self.meta_normal_map = None
@@ -95,31 +96,41 @@ class PVR:
         self.meta_texture_border = None
         self.meta_padding = None
 
-    def load(self):
-        stream = FileStream(self.file_path, "rb")
-
+    # If use_mmap is set then the file is memory mapped and the image data is a view of the mapping
+    # If read_payload is not set then the image data is not read; save() copies it from this file instead
+    def load(self, use_mmap=False, read_payload=True):
+        if use_mmap:
+            stream = MmapStream(self.file_path)
+        else:
+            stream = FileStream(self.file_path, "rb", read_ahead=FileStream.DEFAULT_READ_AHEAD)
+        self.load_stream(stream, read_payload)
+
+    # Load from an asyncio.StreamReader, or from the file path without blocking the event loop
+    # The header and metadata are held and the image data is skipped, as when read_payload is not set
+    async def load_async(self, source=None):
+        stream = AsyncStream(source if source is not None else self.file_path)
+        if await stream.fill(52) == 52:
+            if stream.read_u32() == 0x50565203:
+                stream.set_endian(FileStream.BIG_ENDIAN)
+            stream.set_position(48)
+            await stream.fill(stream.read_u32())
+            await stream.skip()
+            stream.set_position(0)
+            stream.set_endian(FileStream.LITTLE_ENDIAN)
+        self.load_stream(stream, read_payload=False)
+
+    def load_stream(self, stream, read_payload=True):
         # parse header
         self.version = stream.read_u32()
         if self.version == 0x50565203:
             stream.set_endian(FileStream.BIG_ENDIAN)
-        self.flags = stream.read_u32()
-        self.pixel_format = stream.read_u64()
-        self.color_space = stream.read_u32()
-        self.channel_type = stream.read_u32()
-        self.height = stream.read_u32()
-        self.width = stream.read_u32()
-        self.depth = stream.read_u32()
-        self.num_surfaces = stream.read_u32()
-        self.num_faces = stream.read_u32()
-        self.num_mipmaps = stream.read_u32()
-        self.metadata_size = stream.read_u32()
+        (self.flags, self.pixel_format, self.color_space, self.channel_type, self.height, self.width, self.depth,
+         self.num_surfaces, self.num_faces, self.num_mipmaps, self.metadata_size) = stream.read_struct('IQ9I')
 
         # parse metadata
         metadata_end = stream.get_position() + self.metadata_size
         while stream.get_position() < metadata_end:
-            fourcc = stream.read_u32()
-            key = stream.read_u32()
-            size = stream.read_u32()
+            fourcc, key, size = stream.read_struct('3I')
             if fourcc == 0x03525650:    # 'PVR\03'
                 if key == 0:            # texture atlas information
                     self.meta_texture_atlas = stream.read_u8_array(size)
@@ -145,7 +156,11 @@ class PVR:
         self.image_data_size = 0
         for mip_level in range(self.num_mipmaps):
             self.image_data_size += self.get_mipmap_size(mip_level)
-        self.image_data = stream.read_u8_array(self.image_data_size)
+        if read_payload:
+            self.image_data = stream.read_u8_array(self.image_data_size)
+        else:
+            self.image_data = None
+            self.payload_range = (self.file_path, stream.get_position(), self.image_data_size)
 
     def get_width(self):
         return self.width
@@ -196,7 +211,7 @@ class PVR:
         if mip_height < min_height:
             mip_height = min_height
 
-        region_size = (mip_width * mip_height * bits_per_pixel) / 8
+        region_size = (mip_width * mip_height * bits_per_pixel) // 8
         face_size = region_size * self.depth
         surface_size = face_size * self.num_faces
         mip_size = surface_size * self.num_surfaces
@@ -211,68 +226,67 @@ class PVR:
         self.source_checksum = checksum
 
     def save(self):
-        stream = ByteStream(ByteStream.LITTLE_ENDIAN)
-
-        # Write header
-        stream.write_u32(self.version)
-        stream.write_u32(self.flags)
-        stream.write_u64(self.pixel_format)
-        stream.write_u32(self.color_space)
-        stream.write_u32(self.channel_type)
-        stream.write_u32(self.height)
-        stream.write_u32(self.width)
-        stream.write_u32(self.depth)
-        stream.write_u32(self.num_surfaces)
-        stream.write_u32(self.num_faces)
-        stream.write_u32(self.num_mipmaps)
-        stream.write_u32(self.metadata_size)
-
-        # Write metadata
-        if self.meta_texture_atlas is not None:
-            stream.write_u32(0x03525650)
-            stream.write_u32(0)
-            stream.write_u32(len(self.meta_texture_atlas))
-            stream.write_u8_array(self.meta_texture_atlas)
-
-        if self.meta_normal_map is not None:
-            stream.write_u32(0x03525650)
-            stream.write_u32(1)
-            stream.write_u32(len(self.meta_normal_map))
-            stream.write_u8_array(self.meta_normal_map)
-
-        if self.meta_cube_map_order is not None:
-            stream.write_u32(0x03525650)
-            stream.write_u32(2)
-            stream.write_u32(len(self.meta_cube_map_order))
-            stream.write_u8_array(self.meta_cube_map_order)
-
-        if self.meta_texture_orientation is not None:
-            stream.write_u32(0x03525650)
-            stream.write_u32(3)
-            stream.write_u32(len(self.meta_texture_orientation))
-            stream.write_u8_array(self.meta_texture_orientation)
-
-        if self.meta_texture_border is not None:
-            stream.write_u32(0x03525650)
-            stream.write_u32(4)
-            stream.write_u32(len(self.meta_texture_border))
-            stream.write_u8_array(self.meta_texture_border)
-
-        if self.meta_padding is not None:
-            stream.write_u32(0x03525650)
-            stream.write_u32(5)
-            stream.write_u32(len(self.meta_padding))
-            stream.write_u8_array(self.meta_padding)
-
-        if self.source_checksum is not None:
-            # Custom metadata to hold source image checksum
-            stream.write_u32(0x43524353)               # 'SCRC'
-            stream.write_u32(0)
-            stream.write_u32(4)
-            stream.write_u32(self.source_checksum)
-
-        # Write image data
-        stream.write_u8_array(self.image_data)
-
-        with open(self.file_path, "wb") as f:
-            f.write(stream.get_data())
+        with FileStream(self.file_path, "wb", FileStream.LITTLE_ENDIAN, atomic=True) as stream:
+            # Write header
+            stream.write_u32(self.version)
+            stream.write_u32(self.flags)
+            stream.write_u64(self.pixel_format)
+            stream.write_u32(self.color_space)
+            stream.write_u32(self.channel_type)
+            stream.write_u32(self.height)
+            stream.write_u32(self.width)
+            stream.write_u32(self.depth)
+            stream.write_u32(self.num_surfaces)
+            stream.write_u32(self.num_faces)
+            stream.write_u32(self.num_mipmaps)
+            stream.write_u32(self.metadata_size)
+
+            # Write metadata
+            if self.meta_texture_atlas is not None:
+                stream.write_u32(0x03525650)
+                stream.write_u32(0)
+                stream.write_u32(len(self.meta_texture_atlas))
+                stream.write_u8_array(self.meta_texture_atlas)
+
+            if self.meta_normal_map is not None:
+                stream.write_u32(0x03525650)
+                stream.write_u32(1)
+                stream.write_u32(len(self.meta_normal_map))
+                stream.write_u8_array(self.meta_normal_map)
+
+            if self.meta_cube_map_order is not None:
+                stream.write_u32(0x03525650)
+                stream.write_u32(2)
+                stream.write_u32(len(self.meta_cube_map_order))
+                stream.write_u8_array(self.meta_cube_map_order)
+
+            if self.meta_texture_orientation is not None:
+                stream.write_u32(0x03525650)
+                stream.write_u32(3)
+                stream.write_u32(len(self.meta_texture_orientation))
+                stream.write_u8_array(self.meta_texture_orientation)
+
+            if self.meta_texture_border is not None:
+                stream.write_u32(0x03525650)
+                stream.write_u32(4)
+                stream.write_u32(len(self.meta_texture_border))
+                stream.write_u8_array(self.meta_texture_border)
+
+            if self.meta_padding is not None:
+                stream.write_u32(0x03525650)
+                stream.write_u32(5)
+                stream.write_u32(len(self.meta_padding))
+                stream.write_u8_array(self.meta_padding)
+
+            if self.source_checksum is not None:
+                # Custom metadata to hold source image checksum
+                stream.write_u32(0x43524353)               # 'SCRC'
+                stream.write_u32(0)
+                stream.write_u32(4)
+                stream.write_u32(self.source_checksum)
+
+            # Write image data
+            if self.image_data is None:
+                stream.write_file_range(*self.payload_range)
+            else:
+                stream.write_u8_array(self.image_data)
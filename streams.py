@@ -2,23 +2,91 @@
 
 import os
 import io
+import sys
+import json
+import inspect
+import time
+import asyncio
+import mmap
+import array
+import bisect
+import shutil
 import struct
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# array.array type code for unsigned 32-bit values; 'I' is not guaranteed to be 32 bits on every platform
+U32_TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+
+
+# Copy length bytes from offset in the source file descriptor to the current position of the destination file
+# descriptor. The copy is done in the kernel with copy_file_range or sendfile where the platform and file systems
+# support it, otherwise through a bounded buffer, so the data is never held in memory as a whole.
+def copy_file_data(source_fd, offset, destination_fd, length):
+    end = offset + length
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while offset < end:
+                if method == 'copy_file_range':
+                    copied = os.copy_file_range(source_fd, destination_fd, end - offset, offset)
+                else:
+                    copied = os.sendfile(destination_fd, source_fd, offset, end - offset)
+                if copied == 0:
+                    raise ValueError("Source file is shorter than expected")
+                offset += copied
+            return
+        except OSError:
+            # Not supported for these files; continue from the current offset with the next method
+            pass
+    while offset < end:
+        data = os.pread(source_fd, min(end - offset, 1 << 20), offset)
+        if not data:
+            raise ValueError("Source file is shorter than expected")
+        view = memoryview(data)
+        while view:
+            view = view[os.write(destination_fd, view):]
+        offset += len(data)
+
+
+# Return the index of the first occurrence of terminator in buffer[start:end] that is a multiple of alignment bytes
+# from start, or -1 if there is none
+def find_terminator(buffer, start, end, terminator, alignment=1):
+    index = buffer.find(terminator, start, end)
+    while index >= 0 and (index - start) % alignment:
+        index = buffer.find(terminator, index + 1, end)
+    return index
+
 
 class Stream:
     """
-    Virtual base class for ByteStream, FileStream and SocketStream
+    Virtual base class for ByteStream, AsyncStream, FileStream, MmapStream and SocketStream
     """
 
     LITTLE_ENDIAN = 0
     BIG_ENDIAN = 1
 
+    # Precompiled struct.Struct objects shared by all streams; keyed by (endian, format)
+    struct_cache = {}
+
+    # Compiled record schemas shared by all streams; keyed by schema
+    schema_cache = {}
+
+    # Enabled StreamInstrumentation, if any; streams created while it is set are instrumented
+    instrumentation = None
+
     def __init__(self, endian=None):
         self.position = 0
         self.length = 0
         self.endian = endian if endian else self.LITTLE_ENDIAN
         self.endian_stack = []
         self.position_stack = []
+        if Stream.instrumentation is not None:
+            Stream.instrumentation.instrument(self)
 
     def reset(self):
         self.position = 0
@@ -71,6 +139,25 @@ class Stream:
     def is_eof(self):
         return self.position == self.length
 
+    # Return a precompiled struct for the given format in the current endian
+    def get_struct(self, fmt):
+        key = (self.endian, fmt)
+        record = Stream.struct_cache.get(key)
+        if record is None:
+            prefix = '<' if self.endian == self.LITTLE_ENDIAN else '>'
+            record = struct.Struct(prefix + fmt)
+            Stream.struct_cache[key] = record
+        return record
+
+    # Return the field names and combined struct format for a record schema
+    def get_schema(self, schema):
+        compiled = Stream.schema_cache.get(schema)
+        if compiled is None:
+            names = tuple(name for name, fmt in schema)
+            compiled = (names, ''.join(fmt for name, fmt in schema))
+            Stream.schema_cache[schema] = compiled
+        return compiled
+
     def write_u8(self, value):
         raise "Virtual function"
 
@@ -81,52 +168,26 @@ class Stream:
         self.write_u8(1 if value else 0)
 
     def write_u16(self, value):
-        if self.endian == self.LITTLE_ENDIAN:
-            self.write_u8(value & 0xff)
-            self.write_u8(value >> 8)
-        else:
-            self.write_u8(value >> 8)
-            self.write_u8(value & 0xff)
+        self.write_u8_array(self.get_struct('H').pack(value))
 
     def write_u24(self, value):
-        if self.endian == self.LITTLE_ENDIAN:
-            self.write_u8(value & 0xff)
-            self.write_u8((value >> 8) & 0xff)
-            self.write_u8(value >> 16)
-        else:
-            self.write_u8(value >> 16)
-            self.write_u8((value >> 8) & 0xff)
-            self.write_u8(value & 0xff)
+        self.write_u8_array(value.to_bytes(3, 'little' if self.endian == self.LITTLE_ENDIAN else 'big'))
 
     def write_u32(self, value):
-        if self.endian == self.LITTLE_ENDIAN:
-            self.write_u16(value & 0xffff)
-            self.write_u16(value >> 16)
-        else:
-            self.write_u16(value >> 16)
-            self.write_u16(value & 0xffff)
+        self.write_u8_array(self.get_struct('I').pack(value))
 
     def write_u64(self, value):
-        if self.endian == self.LITTLE_ENDIAN:
-            self.write_u32(value & 0xffffffff)
-            self.write_u32(value >> 32)
-        else:
-            self.write_u32(value >> 32)
-            self.write_u32(value & 0xffffffff)
+        self.write_u8_array(self.get_struct('Q').pack(value))
 
     def write_f32(self, value):
-        if self.endian == self.LITTLE_ENDIAN:
-            value = struct.pack('<f', value)
-        else:
-            value = struct.pack('>f', value)
-        self.write_u8_array(value)
+        self.write_u8_array(self.get_struct('f').pack(value))
 
     def write_f64(self, value):
-        if self.endian == self.LITTLE_ENDIAN:
-            value = struct.pack('<d', value)
-        else:
-            value = struct.pack('>d', value)
-        self.write_u8_array(value)
+        self.write_u8_array(self.get_struct('d').pack(value))
+
+    # Write a fixed size record in a single write; fmt is a struct format string without a byte order prefix
+    def write_struct(self, fmt, *values):
+        self.write_u8_array(self.get_struct(fmt).pack(*values))
 
     # variable length unsigned quantity
     # value is stored 7 bits at a time in little-endian order; last value has MSB of 0
@@ -173,46 +234,64 @@ class Stream:
         return False if value == 0 else True
 
     def read_u16(self):
-        if self.endian == self.LITTLE_ENDIAN:
-            value = self.read_u8() + (self.read_u8() << 8)
-        else:
-            value = (self.read_u8() << 8) + self.read_u8()
-        return value
+        return self.get_struct('H').unpack(self.read_u8_array(2))[0]
 
     def read_u24(self):
-        if self.endian == self.LITTLE_ENDIAN:
-            value = self.read_u8() + (self.read_u8() << 8) + (self.read_u8() << 16)
-        else:
-            value = (self.read_u8() << 16) + (self.read_u8() << 8) + self.read_u8()
-        return value
+        value = self.read_u8_array(3)
+        return int.from_bytes(value, 'little' if self.endian == self.LITTLE_ENDIAN else 'big')
 
     def read_u32(self):
-        if self.endian == self.LITTLE_ENDIAN:
-            value = self.read_u16() + (self.read_u16() << 16)
-        else:
-            value = (self.read_u16() << 16) + self.read_u16()
-        return value
+        return self.get_struct('I').unpack(self.read_u8_array(4))[0]
 
     def read_u64(self):
-        if self.endian == self.LITTLE_ENDIAN:
-            value = self.read_u32() + (self.read_u32() << 32)
-        else:
-            value = (self.read_u32() << 32) + self.read_u32()
-        return value
+        return self.get_struct('Q').unpack(self.read_u8_array(8))[0]
 
     def read_f32(self):
-        data = self.read_u8_array(4)
-        if self.endian == self.LITTLE_ENDIAN:
-            return struct.unpack('<f', data)[0]
-        else:
-            return struct.unpack('>f', data)[0]
+        return self.get_struct('f').unpack(self.read_u8_array(4))[0]
 
     def read_f64(self):
-        data = self.read_u8_array(8)
-        if self.endian == self.LITTLE_ENDIAN:
-            return struct.unpack('<d', data)[0]
-        else:
-            return struct.unpack('>d', data)[0]
+        return self.get_struct('d').unpack(self.read_u8_array(8))[0]
+
+    # Read count values of the given array.array type code in a single read, swapping bytes only if the stream endian
+    # differs from the host. Returns an array.array, or a NumPy array if as_numpy is set and NumPy is installed.
+    def read_typed_array(self, typecode, count, as_numpy=False):
+        values = array.array(typecode)
+        data = self.read_u8_array(count * values.itemsize)
+        little_endian = self.endian == self.LITTLE_ENDIAN
+        if as_numpy and numpy is not None:
+            dtype = numpy.dtype(typecode).newbyteorder('<' if little_endian else '>')
+            values = numpy.frombuffer(data, dtype)
+            if little_endian != (sys.byteorder == 'little'):
+                values = values.astype(dtype.newbyteorder('='))
+            return values
+        values.frombytes(data)
+        if little_endian != (sys.byteorder == 'little'):
+            values.byteswap()
+        return values
+
+    def read_u16_array(self, count, as_numpy=False):
+        return self.read_typed_array('H', count, as_numpy)
+
+    def read_u32_array(self, count, as_numpy=False):
+        return self.read_typed_array(U32_TYPECODE, count, as_numpy)
+
+    def read_u64_array(self, count, as_numpy=False):
+        return self.read_typed_array('Q', count, as_numpy)
+
+    def read_f32_array(self, count, as_numpy=False):
+        return self.read_typed_array('f', count, as_numpy)
+
+    # Read a fixed size record in a single read; fmt is a struct format string without a byte order prefix
+    # e.g. stream.read_struct('HHII') returns a tuple of four integers in the current endian
+    def read_struct(self, fmt):
+        record = self.get_struct(fmt)
+        return record.unpack(self.read_u8_array(record.size))
+
+    # Read a fixed size record into a dictionary; schema is a sequence of (name, format) pairs
+    # e.g. stream.read_record((('width', 'I'), ('height', 'I')))
+    def read_record(self, schema):
+        names, fmt = self.get_schema(schema)
+        return dict(zip(names, self.read_struct(fmt)))
 
     def read_vluq(self):
         accumulator = shift = 0
@@ -231,27 +310,27 @@ class Stream:
 
     def read_string(self, length):
         value = self.read_u8_array(length)
-        return value.decode("latin_1")
+        return str(value, "latin_1")
+
+    # Read up to and including a terminator that occurs at a multiple of alignment bytes from the current position
+    # Returns the data preceding the terminator and the number of bytes consumed, including the terminator
+    def read_until(self, terminator, alignment=1):
+        output = bytearray()
+        while True:
+            output.append(self.read_u8())
+            match_start = len(output) - len(terminator)
+            if match_start >= 0 and match_start % alignment == 0 and output.endswith(terminator):
+                return output[:match_start], len(output)
 
     # null terminated string; null character is not returned with string
     def read_nt_string(self):
-        output = bytearray()
-        value = self.read_u8()
-        while value != 0:
-            output.append(value)
-            value = self.read_u8()
-        return output.decode("latin_1")
+        value, consumed = self.read_until(b'\x00')
+        return str(value, "latin_1")
 
     # CR/LF terminated string; CR/LF is returned with string
     def read_crlf_string(self):
-        output = bytearray()
-        value = self.read_u8()
-        while value != 0x0d:
-            output.append(value)
-            value = self.read_u8()
-        output.append(value)
-        output.append(self.read_u8())      # Expected to be 0x0a (line feed)
-        return output.decode("latin_1")
+        value, consumed = self.read_until(b'\r\n')
+        return str(value, "latin_1") + '\r\n'
 
     # string preceded by length as a variable-length-unsigned-quantity
     def read_vluq_string(self):
@@ -260,15 +339,12 @@ class Stream:
 
     def read_utf16_string(self, num_chars):
         value = self.read_u8_array(num_chars*2)
-        return value.decode("utf-16")
+        return str(value, "utf-16")
 
+    # null terminated UTF-16 string in the stream endian; null character is not returned with string
     def read_nt_utf16_string(self):
-        output = bytearray()
-        value = self.read_utf16_string(1)
-        while value != 0:
-            output.append(value)
-            value = self.read_utf16_string(1)
-        return output
+        value, consumed = self.read_until(b'\x00\x00', 2)
+        return str(value, "utf-16-le" if self.endian == self.LITTLE_ENDIAN else "utf-16-be")
 
     def read_name_list(self):
         string_length = self.read_u32()
@@ -316,59 +392,366 @@ class ByteStream(Stream):
         self.position += length
         return value
 
+    def read_until(self, terminator, alignment=1):
+        index = find_terminator(self.data, self.position, self.length, terminator, alignment)
+        if index < 0:
+            raise ValueError("Terminator not found")
+        value = self.data[self.position:index]
+        consumed = index + len(terminator) - self.position
+        self.position += consumed
+        return value, consumed
+
+
+class AsyncStream(ByteStream):
+    """
+    ByteStream that is filled asynchronously, either from an asyncio.StreamReader or from a file read in the event
+    loop's default executor. Once filled it is parsed synchronously without blocking the event loop.
+
+    Data is received in pieces of at most FILL_SIZE bytes, and no more than max_length bytes are held; fill raises
+    ValueError rather than exceed it. Parsers of formats with large media payloads, such as MP4 and AVI, skip those
+    payloads so that only the metadata is held. Skipped data keeps its place in the stream, so later data is read at
+    its file offset, but reading skipped data raises ValueError.
+    """
+
+    DEFAULT_MAX_LENGTH = 64 << 20
+    FILL_SIZE = 1 << 20
+
+    def __init__(self, source, endian=None, max_length=DEFAULT_MAX_LENGTH):
+        ByteStream.__init__(self, endian)
+        self.source = source
+        self.file_name = None if isinstance(source, asyncio.StreamReader) else source
+        self.max_length = max_length
+        # Stream positions of the start and end of each skipped range and the total skipped up to its end
+        self.skipped_starts = array.array('Q')
+        self.skipped_ends = array.array('Q')
+        self.skipped_totals = array.array('Q')
+
+    # Append length bytes from the source, or fewer at end of file, or everything up to end of file if length is
+    # negative; returns the number of bytes appended
+    async def fill(self, length=-1):
+        filled = 0
+        while length < 0 or filled < length:
+            size = self.FILL_SIZE if length < 0 else min(length - filled, self.FILL_SIZE)
+            data = await self.receive(size)
+            if len(self.data) + len(data) > self.max_length:
+                raise ValueError("Stream data exceeds the maximum of %d bytes" % self.max_length)
+            self.data += data
+            self.length += len(data)
+            filled += len(data)
+            if len(data) < size:
+                break
+        return filled
+
+    # Append data from the source until the stream holds everything before position, or end of file is reached
+    async def fill_to(self, position):
+        return await self.fill(max(0, position - self.length))
+
+    # Pass over length bytes of the source without holding them, or everything up to end of file if length is
+    # negative; returns the number of bytes skipped
+    async def skip(self, length=-1):
+        if isinstance(self.source, asyncio.StreamReader):
+            skipped = 0
+            while length < 0 or skipped < length:
+                size = self.FILL_SIZE if length < 0 else min(length - skipped, self.FILL_SIZE)
+                received = len(await self.receive(size))
+                skipped += received
+                if received < size:
+                    break
+        else:
+            loop = asyncio.get_running_loop()
+            file_length = await loop.run_in_executor(None, os.path.getsize, self.file_name)
+            skipped = max(0, file_length - self.length)
+            if length >= 0:
+                skipped = min(skipped, length)
+        if skipped:
+            total = (self.skipped_totals[-1] if self.skipped_totals else 0) + skipped
+            self.skipped_starts.append(self.length)
+            self.skipped_ends.append(self.length + skipped)
+            self.skipped_totals.append(total)
+            self.length += skipped
+        return skipped
+
+    # Receive up to length bytes from the source at the end of the stream; fewer are returned only at end of file
+    async def receive(self, length):
+        if isinstance(self.source, asyncio.StreamReader):
+            try:
+                return await self.source.readexactly(length)
+            except asyncio.IncompleteReadError as error:
+                return error.partial
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.read_file, self.file_name, self.length, length)
+
+    # Return the index in data of the given stream position, and the index of the end of the data held contiguously
+    # from it; raises ValueError if the position is in a skipped range
+    def get_data_range(self, position):
+        if not self.skipped_starts:
+            return position, len(self.data)
+        index = bisect.bisect_right(self.skipped_starts, position)
+        if index and position < self.skipped_ends[index - 1]:
+            raise ValueError("Stream data at %d was skipped" % position)
+        skipped = self.skipped_totals[index - 1] if index else 0
+        end = self.skipped_starts[index] - skipped if index < len(self.skipped_starts) else len(self.data)
+        return position - skipped, end
+
+    def read_u8(self):
+        start, end = self.get_data_range(self.position)
+        value = self.data[start]
+        self.position += 1
+        return value
+
+    def read_u8_array(self, length):
+        start, end = self.get_data_range(self.position)
+        if start + length > end and end < len(self.data):
+            raise ValueError("Stream data at %d was skipped" % (self.position + end - start))
+        value = self.data[start:start + length]
+        self.position += length
+        return value
+
+    def read_until(self, terminator, alignment=1):
+        start, end = self.get_data_range(self.position)
+        index = find_terminator(self.data, start, end, terminator, alignment)
+        if index < 0:
+            raise ValueError("Terminator not found")
+        value = self.data[start:index]
+        consumed = index + len(terminator) - start
+        self.position += consumed
+        return value, consumed
+
+    @staticmethod
+    def read_file(file_name, offset, length):
+        with io.open(file_name, 'rb') as handle:
+            handle.seek(offset)
+            return handle.read(length)
+
 
 class FileStream(Stream):
+    """
+    Stream over a file. The stream position is tracked arithmetically and the file handle is only repositioned when
+    data is physically read or written. If read_ahead is non-zero then small reads are served from a read-ahead buffer
+    of that many bytes, and seeks within the buffered window do not touch the file.
+
+    If atomic is set then a file opened for writing is written to a temporary file alongside it, which replaces the
+    named file when the stream is closed. This allows a file to be rewritten while data loaded from it, possibly
+    memory mapped, is still being written out. Used as a context manager the temporary file is discarded on error.
+    """
 
-    def __init__(self, file_name, mode, endian=None):
+    DEFAULT_READ_AHEAD = 65536
+
+    def __init__(self, file_name, mode, endian=None, read_ahead=0, atomic=False):
         Stream.__init__(self, endian)
-        self.handle = io.open(file_name, mode)
-        self.length = os.path.getsize(file_name)
+        self.file_name = file_name
+        self.temp_name = None
+        if atomic:
+            self.temp_name = '%s.%d.%x.tmp' % (file_name, os.getpid(), id(self))
+            self.handle = io.open(self.temp_name, mode.replace('w', 'x'))
+        else:
+            self.handle = io.open(file_name, mode)
+        self.length = os.path.getsize(self.temp_name if atomic else file_name)
+        self.handle_position = 0
+        self.read_ahead = read_ahead
+        self.buffer = b''
+        self.buffer_view = memoryview(self.buffer)
+        self.buffer_start = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.temp_name is not None:
+            self.handle.close()
+            os.remove(self.temp_name)
+            self.temp_name = None
+        else:
+            self.close()
 
     def close(self):
         self.handle.close()
-
-    def set_position(self, offset, whence=io.SEEK_SET):
-        Stream.set_position(self, offset, whence)
-        self.handle.seek(offset, whence)
-
-    def get_position(self):
-        self.position = self.handle.tell()
-        return self.position
+        if self.temp_name is not None:
+            # Keep the permissions of the file being replaced
+            if os.path.exists(self.file_name):
+                shutil.copymode(self.file_name, self.temp_name)
+            os.replace(self.temp_name, self.file_name)
+            self.temp_name = None
 
     def get_remaining(self):
-        return self.length - self.handle.tell()
-
-    def is_eof(self):
-        return self.handle.tell() == self.length
+        return self.length - self.position
+
+    # Move the file handle to the stream position if it is not already there
+    def seek_handle(self):
+        if self.handle_position != self.position:
+            self.handle.seek(self.position)
+            self.handle_position = self.position
+
+    # Refill the read-ahead buffer starting at the stream position
+    def fill_buffer(self):
+        self.seek_handle()
+        self.buffer = self.handle.read(self.read_ahead)
+        self.buffer_view = memoryview(self.buffer)
+        self.buffer_start = self.position
+        self.handle_position += len(self.buffer)
 
     def write_u8(self, value):
-        self.handle.write(value)
-        self.length += 1
+        self.buffer = b''
+        self.seek_handle()
+        self.handle.write(bytes((value,)))
         self.position += 1
+        self.handle_position = self.position
+        if self.position > self.length:
+            self.length = self.position
 
     def write_u8_array(self, data):
+        self.buffer = b''
+        self.seek_handle()
         self.handle.write(data)
-        self.length += len(data)
         self.position += len(data)
+        self.handle_position = self.position
+        if self.position > self.length:
+            self.length = self.position
+
+    # Write length bytes from offset in another file without passing them through memory
+    def write_file_range(self, file_name, offset, length):
+        self.buffer = b''
+        self.seek_handle()
+        self.handle.flush()
+        with io.open(file_name, 'rb') as source:
+            copy_file_data(source.fileno(), offset, self.handle.fileno(), length)
+        self.position += length
+        # Resynchronise the buffered handle with the file descriptor, which has been advanced by the copy
+        self.handle.seek(self.position)
+        self.handle_position = self.position
+        if self.position > self.length:
+            self.length = self.position
 
     def read_u8(self):
-        return ord(self.handle.read(1))
+        if self.read_ahead:
+            offset = self.position - self.buffer_start
+            if offset < 0 or offset >= len(self.buffer):
+                self.fill_buffer()
+                offset = 0
+            value = self.buffer[offset]
+        else:
+            self.seek_handle()
+            value = ord(self.handle.read(1))
+            self.handle_position += 1
+        self.position += 1
+        return value
 
     def read_u8_array(self, length):
-        return bytearray(self.handle.read(length))
+        if self.read_ahead and length < self.read_ahead:
+            offset = self.position - self.buffer_start
+            if offset < 0 or offset + length > len(self.buffer):
+                self.fill_buffer()
+                offset = 0
+            value = bytearray(self.buffer_view[offset:offset + length])
+        else:
+            # Unbuffered, or large enough that it would not benefit from the read-ahead buffer
+            self.seek_handle()
+            value = bytearray(self.handle.read(length))
+            self.handle_position += len(value)
+        self.position += len(value)
+        return value
+
+    def read_until(self, terminator, alignment=1):
+        if self.read_ahead:
+            offset = self.position - self.buffer_start
+            if offset < 0 or offset >= len(self.buffer):
+                self.fill_buffer()
+                offset = 0
+            index = find_terminator(self.buffer, offset, len(self.buffer), terminator, alignment)
+            if index >= 0:
+                value = bytearray(self.buffer_view[offset:index])
+                consumed = index + len(terminator) - offset
+                self.position += consumed
+                return value, consumed
+
+        # The terminator is not within the read-ahead buffer so scan forward through the file a window at a time
+        window = self.read_ahead if self.read_ahead else 256
+        value = bytearray()
+        self.seek_handle()
+        while True:
+            # Resume the search so that a terminator split across windows is still found
+            search_start = max(0, len(value) - len(terminator) + 1)
+            search_start -= search_start % alignment
+            data = self.handle.read(window)
+            self.handle_position += len(data)
+            if not data:
+                raise ValueError("Terminator not found")
+            value += data
+            index = find_terminator(value, search_start, len(value), terminator, alignment)
+            if index >= 0:
+                break
+        consumed = index + len(terminator)
+        self.position += consumed
+        return value[:index], consumed
 
     def flush(self):
         self.handle.flush()
 
 
+class MmapStream(Stream):
+    """
+    Read-only stream over a memory mapped file. Arrays are returned as memoryview slices of the mapping rather than
+    copies, so large payloads can be held without being read into memory.
+    """
+
+    def __init__(self, file_name, endian=None):
+        Stream.__init__(self, endian)
+        self.length = os.path.getsize(file_name)
+        if self.length > 0:
+            with io.open(file_name, 'rb') as handle:
+                self.map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self.map)
+        else:
+            # Empty files cannot be mapped
+            self.map = None
+            self.data = memoryview(b'')
+
+    def close(self):
+        # The mapping can only be closed once all views returned by read_u8_array have been released
+        self.data.release()
+        if self.map is not None:
+            self.map.close()
+
+    def read_u8(self):
+        value = self.data[self.position]
+        self.position += 1
+        return value
+
+    def read_u8_array(self, length):
+        value = self.data[self.position:self.position + length]
+        self.position += length
+        return value
+
+    def read_until(self, terminator, alignment=1):
+        index = -1
+        if self.map is not None:
+            index = find_terminator(self.map, self.position, self.length, terminator, alignment)
+        if index < 0:
+            raise ValueError("Terminator not found")
+        value = self.data[self.position:index]
+        consumed = index + len(terminator) - self.position
+        self.position += consumed
+        return value, consumed
+
+
 class SocketStream(Stream):
+    """
+    Stream over a socket. Received data is held in a fixed capacity buffer filled with recv_into; consumed data is
+    discarded by compacting the buffer when it fills, so memory use is bounded by the buffer size however much data
+    passes through the stream. Reads larger than the buffer are received directly into the returned array. The stream
+    can only seek backwards within data that is still held in the buffer.
+    """
 
-    def __init__(self, socket, endian=None):
+    DEFAULT_BUFFER_SIZE = 65536
+
+    def __init__(self, socket, endian=None, buffer_size=DEFAULT_BUFFER_SIZE):
         Stream.__init__(self, endian)
         self.socket = socket
         self.write_buffer = bytearray()
-        self.read_buffer = bytearray()
-        self.read_buffer_length = 0
+        self.read_buffer = bytearray(buffer_size)
+        self.read_view = memoryview(self.read_buffer)
+        self.read_start = 0             # index in read buffer of the current position
+        self.read_end = 0               # index in read buffer of the end of received data
 
     def close(self):
         self.socket.close()
@@ -382,19 +765,90 @@ class SocketStream(Stream):
             raise ValueError("Invalid position basis")
         if new_position < 0:
             raise ValueError("Position out of range")
+        distance = new_position - self.position
+        if distance < -self.read_start:
+            raise ValueError("Position is no longer buffered")
+        if distance <= self.read_end - self.read_start:
+            self.read_start += distance
+        else:
+            # Discard everything buffered then receive and discard the remainder
+            remaining = distance - (self.read_end - self.read_start)
+            self.read_start = self.read_end = 0
+            while remaining > 0:
+                received = self.socket.recv_into(self.read_view, min(remaining, len(self.read_buffer)))
+                if received == 0:
+                    raise ValueError("Socket closed")
+                remaining -= received
         self.position = new_position
 
+    # Move unconsumed data to the start of the read buffer
+    def compact(self):
+        available = self.read_end - self.read_start
+        self.read_view[:available] = self.read_view[self.read_start:self.read_end]
+        self.read_start = 0
+        self.read_end = available
+
+    # Receive data into the free space at the end of the read buffer
+    def receive(self):
+        received = self.socket.recv_into(self.read_view[self.read_end:])
+        if received == 0:
+            raise ValueError("Socket closed")
+        self.read_end += received
+
     def read_u8(self):
+        if self.read_start < self.read_end:
+            value = self.read_buffer[self.read_start]
+            self.read_start += 1
+            self.position += 1
+            return value
         return self.read_u8_array(1)[0]
 
     def read_u8_array(self, length):
         # Read data from socket; wait until enough data is available to satisfy request
-        while self.position + length > len(self.read_buffer):
-            bytes_needed = self.position + length - len(self.read_buffer)
-            self.read_buffer += self.socket.recv(bytes_needed)
-        data = self.read_buffer[self.position:self.position + length]
+        available = self.read_end - self.read_start
+        if length > available:
+            if length > len(self.read_buffer):
+                value = bytearray(length)
+                value[:available] = self.read_view[self.read_start:self.read_end]
+                self.read_start = self.read_end = 0
+                view = memoryview(value)
+                while available < length:
+                    received = self.socket.recv_into(view[available:])
+                    if received == 0:
+                        raise ValueError("Socket closed")
+                    available += received
+                self.position += length
+                return value
+            if self.read_start + length > len(self.read_buffer):
+                self.compact()
+            while self.read_end - self.read_start < length:
+                self.receive()
+        value = bytearray(self.read_view[self.read_start:self.read_start + length])
+        self.read_start += length
         self.position += length
-        return data
+        return value
+
+    def read_until(self, terminator, alignment=1):
+        searched = 0
+        while True:
+            # Resume the search so that a terminator split across receives is still found
+            search_start = max(0, searched - len(terminator) + 1)
+            search_start -= search_start % alignment
+            index = find_terminator(self.read_buffer, self.read_start + search_start, self.read_end, terminator,
+                                    alignment)
+            if index >= 0:
+                break
+            searched = self.read_end - self.read_start
+            if self.read_end == len(self.read_buffer):
+                if self.read_start == 0:
+                    raise ValueError("Terminator not found within read buffer")
+                self.compact()
+            self.receive()
+        value = bytearray(self.read_view[self.read_start:index])
+        consumed = index + len(terminator) - self.read_start
+        self.read_start += consumed
+        self.position += consumed
+        return value, consumed
 
     def write_u8(self, value):
         self.write_buffer.append(value)
@@ -411,3 +865,126 @@ class SocketStream(Stream):
         self.socket.sendall(self.write_buffer)
         self.write_buffer = bytearray()
         self.length = 0
+
+
+class StreamInstrumentation:
+    """
+    Counts read calls, bytes read, seeks, seek distance, write calls, bytes written and time spent in streams,
+    attributed to the function outside this module that made each call, e.g. 'JPEG.load_stream' or 'TIFF.parse_ifd'.
+    If by_line is set then counts are further split by the calling line, which identifies the marker or atom branch.
+
+    While enabled, each stream created has its class replaced by an instrumented subclass. Streams created while
+    instrumentation is disabled are untouched, so disabled instrumentation costs nothing.
+    """
+
+    POSITION_METHODS = ('set_position', 'push_position', 'pop_position')
+
+    def __init__(self, by_line=False):
+        self.by_line = by_line
+        self.counters = {}
+        self.classes = {}
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disable()
+
+    def enable(self):
+        Stream.instrumentation = self
+
+    def disable(self):
+        if Stream.instrumentation is self:
+            Stream.instrumentation = None
+
+    def reset(self):
+        self.counters = {}
+
+    # Instrument an existing stream
+    def instrument(self, stream):
+        stream_class = type(stream)
+        if stream_class in self.classes.values():
+            return
+        instrumented_class = self.classes.get(stream_class)
+        if instrumented_class is None:
+            instrumented_class = self.create_class(stream_class)
+            self.classes[stream_class] = instrumented_class
+        stream.instrumentation_depth = 0
+        stream.__class__ = instrumented_class
+
+    def create_class(self, stream_class):
+        methods = {}
+        for name in dir(stream_class):
+            if name.startswith('read_') or name.startswith('write_') or name in self.POSITION_METHODS:
+                method = getattr(stream_class, name)
+                # Static methods such as AsyncStream.read_file are not stream operations
+                if callable(method) and not isinstance(inspect.getattr_static(stream_class, name), staticmethod):
+                    methods[name] = self.wrap(method, name)
+        return type(stream_class.__name__, (stream_class,), methods)
+
+    def wrap(self, method, name):
+        instrumentation = self
+        if name.startswith('read_'):
+            kind = 'read'
+        elif name.startswith('write_'):
+            kind = 'write'
+        else:
+            kind = 'seek'
+
+        def instrumented(stream, *args, **kwargs):
+            # Only the outermost call is counted, e.g. read_u32 is counted once and not again for its read_u8_array
+            if stream.instrumentation_depth:
+                return method(stream, *args, **kwargs)
+            stream.instrumentation_depth = 1
+            position = stream.position
+            length = stream.length
+            start_time = time.perf_counter()
+            try:
+                return method(stream, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start_time
+                stream.instrumentation_depth = 0
+                instrumentation.record(kind, stream, position, length, elapsed)
+
+        instrumented.__name__ = name
+        return instrumented
+
+    def record(self, kind, stream, position, length, elapsed):
+        caller = self.get_caller()
+        counters = self.counters.get(caller)
+        if counters is None:
+            counters = dict.fromkeys(('read_calls', 'bytes_read', 'seeks', 'seek_distance', 'write_calls',
+                                      'bytes_written'), 0)
+            counters['time'] = 0.0
+            self.counters[caller] = counters
+        if kind == 'read':
+            counters['read_calls'] += 1
+            counters['bytes_read'] += stream.position - position
+        elif kind == 'write':
+            # SocketStream only advances the length when writing; other streams advance the position
+            counters['write_calls'] += 1
+            counters['bytes_written'] += max(stream.position - position, stream.length - length)
+        else:
+            counters['seeks'] += 1
+            counters['seek_distance'] += abs(stream.position - position)
+        counters['time'] += elapsed
+
+    # Name the first function on the call stack that is outside this module
+    def get_caller(self):
+        frame = sys._getframe(2)
+        while frame is not None and frame.f_globals.get('__name__') == __name__:
+            frame = frame.f_back
+        if frame is None:
+            return '<unknown>'
+        code = frame.f_code
+        caller = getattr(code, 'co_qualname', code.co_name)
+        if self.by_line:
+            caller += ':%d' % frame.f_lineno
+        return caller
+
+    def to_dict(self):
+        return {caller: dict(counters) for caller, counters in self.counters.items()}
+
+    def to_json(self, indent=None):
+        return json.dumps(self.to_dict(), indent=indent, sort_keys=True)
@@ -0,0 +1,221 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+import os
+import zlib
+import time
+import socket
+import asyncio
+import datetime
+import struct
+import tempfile
+import threading
+import unittest
+from streams import AsyncStream, SocketStream
+from psd import PSD
+from mp4 import MP4
+from avi import AVI
+from ktx import KTX
+from png import PNG
+
+PSD_HEADER = struct.pack('>4sH6xHIIHH', b'8BPS', 1, 3, 480, 640, 8, 3)
+
+
+def make_mp4(media_length):
+    # mvhd with a creation time of 2020-01-02 03:04:05
+    creation_time = 2082844800 + int(datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc).timestamp())
+    mvhd = struct.pack('>B3xIIIIIH10x36xIIIIIII', 0, creation_time, creation_time, 1000, 0, 0x10000, 0x100,
+                       0, 0, 0, 0, 0, 0, 2)
+    ftyp = struct.pack('>I4s4sI4s', 20, b'ftyp', b'isom', 0, b'isom')
+    mdat = struct.pack('>I4s', 8 + media_length, b'mdat') + bytes(media_length)
+    moov = struct.pack('>I4sI4s', 16 + len(mvhd), b'moov', 8 + len(mvhd), b'mvhd') + mvhd
+    return ftyp + mdat + moov
+
+
+def make_avi(movie_length):
+    idit = b'IDIT' + struct.pack('<I', 26) + b'Thu Jan 02 03:04:05 2020\n\x00'
+    hdrl = b'LIST' + struct.pack('<I', 4 + len(idit)) + b'hdrl' + idit
+    movi = b'LIST' + struct.pack('<I', 4 + movie_length) + b'movi' + bytes(movie_length)
+    body = b'AVI ' + hdrl + movi
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def make_ktx(payload_length):
+    metadata = struct.pack('<I', 9) + b'SCRC\x00' + struct.pack('<I', 0x12345678) + bytes(3)
+    header = b'\xabKTX 11\xbb\r\n\x1a\n' + struct.pack('<13I', 0x04030201, 0, 1, 0x1908, 0x83f0, 0x1908, 64, 64, 0,
+                                                          0, 1, 1, len(metadata))
+    return header + metadata + struct.pack('<I', payload_length) + bytes(payload_length)
+
+
+def make_png(image_length):
+    def chunk(type, data):
+        return struct.pack('>I', len(data)) + type + data + struct.pack('>I', zlib.crc32(type + data))
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 64, 64, 8, 0, 0, 0, 0)) +
+            chunk(b'IDAT', bytes(image_length)) + chunk(b'tEXt', b'Title\x00After the image') +
+            chunk(b'tIME', struct.pack('>HBBBBB', 2020, 1, 2, 3, 4, 5)) + chunk(b'IEND', b''))
+
+
+class AsyncStreamTest(unittest.TestCase):
+    # Serve the pieces from a local asyncio server, pausing between them so that each arrives separately, and run
+    # load with a StreamReader connected to it
+    def serve(self, pieces, load):
+        async def handle(reader, writer):
+            for piece in pieces:
+                writer.write(piece)
+                await writer.drain()
+                await asyncio.sleep(0.01)
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                return await load(reader)
+            finally:
+                writer.close()
+                server.close()
+                await server.wait_closed()
+
+        return asyncio.run(run())
+
+    def test_header_in_pieces(self):
+        psd = PSD(None)
+        self.serve([PSD_HEADER[:10], PSD_HEADER[10:]], psd.load_async)
+        self.assertEqual((psd.get_width(), psd.get_height(), psd.get_depth()), (640, 480, 8))
+
+    def test_fill_to_end(self):
+        data = os.urandom(AsyncStream.FILL_SIZE + 1000)
+
+        async def load(reader):
+            stream = AsyncStream(reader)
+            self.assertEqual(await stream.fill(), len(data))
+            return stream
+
+        stream = self.serve([data[:5000], data[5000:]], load)
+        self.assertEqual(stream.get_data(), data)
+
+    def test_max_length(self):
+        async def load(reader):
+            await AsyncStream(reader, max_length=1000).fill()
+
+        with self.assertRaises(ValueError):
+            self.serve([bytes(5000)], load)
+
+    def test_mp4_media_data_is_skipped(self):
+        mp4 = MP4()
+        self.serve([make_mp4(3 << 20)], mp4.load_async)
+        self.assertEqual(mp4.get_image_time(), datetime.datetime(2020, 1, 2, 3, 4, 5))
+        self.assertLess(len(mp4.stream.get_data()), 1024)
+
+    def test_avi_movie_data_is_skipped(self):
+        avi = AVI()
+        self.serve([make_avi(3 << 20)], avi.load_async)
+        self.assertEqual(avi.get_image_time(), datetime.datetime(2020, 1, 2, 3, 4, 5))
+        self.assertLess(len(avi.stream.get_data()), 1024)
+
+    def test_ktx_payload_is_skipped(self):
+        ktx = KTX()
+        self.serve([make_ktx(3 << 20)], ktx.load_async)
+        self.assertEqual(ktx.get_source_checksum(), 0x12345678)
+        self.assertEqual(ktx.mip_images, [])
+        self.assertEqual(ktx.payload_range[1:], (80, 4 + (3 << 20)))
+
+    def test_png_image_data_is_skipped(self):
+        png = PNG()
+        self.serve([make_png(3 << 20)], png.load_async)
+        self.assertEqual(png.get_image_time(), datetime.datetime(2020, 1, 2, 3, 4, 5))
+        self.assertEqual(png.get_text(), {'Title': 'After the image'})
+        self.assertEqual(len(png.get_chunk('IHDR', check_crc=True)), 13)
+        self.assertLess(len(png.stream.get_data()), 1024)
+        with self.assertRaises(ValueError):
+            png.get_chunk('IDAT')
+
+    def test_file_skip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            file_name = os.path.join(directory, 'a.mp4')
+            with open(file_name, 'wb') as handle:
+                handle.write(make_mp4(3 << 20))
+            mp4 = MP4()
+            asyncio.run(mp4.load_async(file_name))
+        self.assertEqual(mp4.get_image_time(), datetime.datetime(2020, 1, 2, 3, 4, 5))
+        self.assertEqual(mp4.stream.get_length(), 20 + 8 + (3 << 20) + 116)
+
+        # Skipped data cannot be read, but data after it is read at its file offset
+        stream = mp4.stream
+        stream.set_position(100)
+        with self.assertRaises(ValueError):
+            stream.read_u8_array(4)
+        stream.set_position(24)
+        with self.assertRaises(ValueError):
+            stream.read_u8_array(8)
+        stream.set_position(20 + 8 + (3 << 20) + 4)
+        self.assertEqual(stream.read_string(4), 'moov')
+
+
+class SocketStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.sender, receiver = socket.socketpair()
+        receiver.settimeout(5)
+        self.stream = SocketStream(receiver, SocketStream.BIG_ENDIAN, buffer_size=64)
+
+    def tearDown(self):
+        self.sender.close()
+        self.stream.close()
+
+    # Send the pieces from another thread, pausing between them so that each arrives in a separate receive
+    def send(self, pieces, close=False):
+        def run():
+            for piece in pieces:
+                self.sender.sendall(piece)
+                time.sleep(0.01)
+            if close:
+                self.sender.shutdown(socket.SHUT_WR)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_compaction(self):
+        data = bytes(range(252)) * 4
+        self.send([data[i:i + 40] for i in range(0, len(data), 40)])
+        for i in range(0, len(data), 24):
+            self.assertEqual(self.stream.read_u8_array(24), data[i:i + 24])
+        self.assertEqual(len(self.stream.read_buffer), 64)
+        self.assertEqual(self.stream.get_position(), len(data))
+
+    def test_large_read(self):
+        data = os.urandom(1000)
+        self.send([data[:10], data[10:500], data[500:]])
+        self.assertEqual(self.stream.read_u8_array(4), data[:4])
+        self.assertEqual(self.stream.read_u8_array(900), data[4:904])
+        self.assertEqual(self.stream.read_u8_array(96), data[904:])
+        self.assertEqual(len(self.stream.read_buffer), 64)
+
+    def test_skip(self):
+        data = os.urandom(1000)
+        self.send([data[:100], data[100:]])
+        self.assertEqual(self.stream.read_u32(), int.from_bytes(data[:4], 'big'))
+        self.stream.set_position(-2)
+        self.assertEqual(self.stream.read_u16(), int.from_bytes(data[2:4], 'big'))
+        self.stream.set_position(500)
+        self.assertEqual(self.stream.get_position(), 504)
+        self.assertEqual(self.stream.read_u8_array(8), data[504:512])
+        with self.assertRaises(ValueError):
+            self.stream.set_position(0, os.SEEK_SET)
+
+    def test_read_until(self):
+        self.send([b'first li', b'ne\r', b'\nsecond\x00\x00 line\r\n'])
+        self.assertEqual(self.stream.read_crlf_string(), 'first line\r\n')
+        self.assertEqual(self.stream.read_nt_string(), 'second')
+        self.assertEqual(self.stream.read_u8(), 0)
+        self.assertEqual(self.stream.read_crlf_string(), ' line\r\n')
+
+    def test_closed(self):
+        self.send([b'abc'], close=True)
+        with self.assertRaises(ValueError):
+            self.stream.read_u8_array(4)
+
+
+if __name__ == '__main__':
+    unittest.main()
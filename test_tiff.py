@@ -0,0 +1,74 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+import datetime
+import struct
+import unittest
+from streams import ByteStream
+from tiff import TIFF
+
+
+# Build a BigTIFF with an IFD0 holding the image width and a LONG pointer to an Exif IFD holding DateTimeOriginal
+# Values shorter than the 8 byte value field are left justified in it, as the specification requires
+def make_big_tiff(endian):
+    def entry(tag, type, count, value):
+        if type == 3:
+            field = struct.pack(endian + 'H', value).ljust(8, b'\x00')
+        elif type == 4:
+            field = struct.pack(endian + 'L', value).ljust(8, b'\x00')
+        else:
+            field = struct.pack(endian + 'Q', value)
+        return struct.pack(endian + 'HHQ', tag, type, count) + field
+
+    date = b'2020:01:02 03:04:05\x00'
+    ifd0_offset = 16
+    exif_offset = ifd0_offset + 8 + 2 * 20 + 8
+    date_offset = exif_offset + 8 + 20 + 8
+    data = (b'MM' if endian == '>' else b'II') + struct.pack(endian + 'HHHQ', 43, 8, 0, ifd0_offset)
+    data += struct.pack(endian + 'Q', 2) + entry(0x0100, 3, 1, 7) + entry(TIFF.EXIF_IFD, 4, 1, exif_offset)
+    data += struct.pack(endian + 'Q', 0)
+    data += struct.pack(endian + 'Q', 1) + entry(0x9003, 2, len(date), date_offset) + struct.pack(endian + 'Q', 0)
+    return data + date
+
+
+# Build a classic little endian TIFF holding a 4x2 8-bit grayscale image in one uncompressed strip
+def make_tiff(pixels):
+    entries = [(0x0100, 3, 1, 4), (0x0101, 3, 1, 2), (0x0102, 3, 1, 8), (0x0103, 3, 1, 1), (0x0106, 3, 1, 1),
+               (0x0111, 4, 1, 8), (0x0115, 3, 1, 1), (0x0116, 3, 1, 2), (0x0117, 4, 1, len(pixels))]
+    data = b'II' + struct.pack('<HI', 42, 8 + len(pixels)) + pixels + struct.pack('<H', len(entries))
+    for tag, type, count, value in entries:
+        data += struct.pack('<HHL', tag, type, count) + struct.pack('<H' if type == 3 else '<L', value).ljust(4, b'\x00')
+    return data + struct.pack('<L', 0)
+
+
+class TIFFImageTest(unittest.TestCase):
+    def test_offset_tiff(self):
+        # Offsets are relative to the TIFF header, as for Exif data embedded in another file
+        pixels = bytes(range(10, 18))
+        stream = ByteStream()
+        stream.set_data(b'Exif\x00\x00' + make_tiff(pixels))
+        stream.set_position(6)
+        tiff = TIFF()
+        tiff.init(stream)
+        tiff.parse()
+        self.assertEqual(bytes(tiff.read_image()), pixels)
+
+
+class BigTIFFTest(unittest.TestCase):
+    def parse(self, data):
+        stream = ByteStream()
+        stream.set_data(data)
+        tiff = TIFF()
+        tiff.init(stream)
+        tiff.parse()
+        return tiff
+
+    def test_exif_pointer(self):
+        for endian in ('<', '>'):
+            tiff = self.parse(make_big_tiff(endian))
+            self.assertEqual(tiff.get_tag(0x0100), 7)
+            self.assertEqual(tiff.get_tag(0x9003, TIFF.EXIF_IFD), '2020:01:02 03:04:05')
+            self.assertEqual(tiff.get_image_time(), datetime.datetime(2020, 1, 2, 3, 4, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,30 +3,273 @@
 # For TIFF format see http://www.fileformat.info/format/tiff/egff.htm
 # For EXIF tags see http://www.sno.phy.queensu.ca/~phil/exiftool/TagNames/EXIF.html
 
+import os
+import sys
+import zlib
+import array
+import asyncio
 import datetime
-from streams import FileStream
+import collections
+import concurrent.futures
+from streams import AsyncStream, FileStream, MmapStream, U32_TYPECODE
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Size in bytes of one element of each field type, indexed by type
+# 1 BYTE, 2 ASCII, 3 SHORT, 4 LONG, 5 RATIONAL, 6 SBYTE, 7 UNDEFINED, 8 SSHORT, 9 SLONG, 10 SRATIONAL, 11 FLOAT,
+# 12 DOUBLE, 13 IFD; BigTIFF adds 16 LONG8, 17 SLONG8, 18 IFD8
+type_sizes = (0, 1, 1, 2, 4, 8, 1, 1, 2, 4, 8, 4, 8, 4, 0, 0, 8, 8, 8)
+
+# struct format of one element of each numeric field type; rationals are read as two elements
+type_formats = {3: 'H', 4: 'L', 5: 'L', 8: 'h', 9: 'l', 10: 'l', 11: 'f', 12: 'd', 13: 'L', 16: 'Q', 17: 'q', 18: 'Q'}
+
+
+class TIFFTagTable:
+    """
+    Compact table of the entries of every IFD that has been parsed, held in parallel arrays rather than as an object
+    per tag. value_positions holds the stream position of each value, which is the value field of the entry itself for
+    values of 4 bytes or less; values are only decoded when requested.
+    """
+
+    __slots__ = ('ifds', 'tags', 'types', 'counts', 'value_positions')
 
-class TIFF:
     def __init__(self):
+        self.ifds = array.array('L')
+        self.tags = array.array('H')
+        self.types = array.array('H')
+        self.counts = array.array('Q')
+        self.value_positions = array.array('Q')
+
+    def __len__(self):
+        return len(self.tags)
+
+    def append(self, ifd, tag, type, count, value_position):
+        self.ifds.append(ifd)
+        self.tags.append(tag)
+        self.types.append(type)
+        self.counts.append(count)
+        self.value_positions.append(value_position)
+
+    # Return the index of tag in ifd, or -1 if it is not present
+    def find(self, tag, ifd):
+        tags = self.tags
+        index = -1
+        try:
+            while True:
+                index = tags.index(tag, index + 1)
+                if self.ifds[index] == ifd:
+                    return index
+        except ValueError:
+            return -1
+
+
+# Decompress PackBits run length encoded data
+def decode_packbits(data):
+    data = bytes(data)
+    result = bytearray()
+    position = 0
+    length = len(data)
+    while position < length:
+        header = data[position]
+        position += 1
+        if header < 128:
+            result += data[position:position + header + 1]
+            position += header + 1
+        elif header > 128:
+            result += data[position:position + 1] * (257 - header)
+            position += 1
+    return result
+
+
+# Decompress TIFF LZW data; codes are written most significant bit first and widen one code early
+def decode_lzw(data):
+    data = bytes(data) + b'\x00\x00\x00'
+    num_bits = (len(data) - 3) * 8
+    result = bytearray()
+    table = [bytes((i,)) for i in range(256)] + [b'', b'']
+    code_length = 9
+    bit_position = 0
+    previous = None
+    while bit_position + code_length <= num_bits:
+        index = bit_position >> 3
+        bits = (data[index] << 16) | (data[index + 1] << 8) | data[index + 2]
+        code = (bits >> (24 - code_length - (bit_position & 7))) & ((1 << code_length) - 1)
+        bit_position += code_length
+        if code == 256:             # clear code
+            del table[258:]
+            code_length = 9
+            previous = None
+            continue
+        if code == 257:             # end of information
+            break
+        if previous is None:
+            entry = table[code]
+        else:
+            if code < len(table):
+                entry = table[code]
+                table.append(previous + entry[:1])
+            elif code == len(table):
+                entry = previous + previous[:1]
+                table.append(entry)
+            else:
+                raise ValueError("Invalid LZW code")
+            if len(table) + 1 >= (1 << code_length) and code_length < 12:
+                code_length += 1
+        result += entry
+        previous = entry
+    return result
+
+
+class TIFFImage:
+    """
+    Layout of the image data of one IFD. Strips are treated as tiles the width of the image, so chunk_width and
+    chunk_height are the tile size or the image width and rows per strip; offsets and byte_counts index the chunks in
+    row major order.
+    """
+
+    __slots__ = ('width', 'height', 'samples_per_pixel', 'bits_per_sample', 'compression', 'predictor',
+                 'chunk_width', 'chunk_height', 'chunks_across', 'offsets', 'byte_counts')
+
+    def get_bytes_per_pixel(self):
+        return self.samples_per_pixel * self.bits_per_sample // 8
+
+
+class TIFF:
+    # IFD identifiers used in the tag table; IFDs in the main chain are numbered from 0 and sub-IFDs are identified by
+    # the tag that points to them
+    IFD0 = 0
+    IFD1 = 1
+    EXIF_IFD = 0x8769
+    GPS_IFD = 0x8825
+    INTEROP_IFD = 0xa005
+
+    # Limits on the nesting of sub-IFDs and on the total number of entries parsed, so that crafted files cannot make
+    # parsing run without bound
+    DEFAULT_MAX_DEPTH = 4
+    DEFAULT_MAX_ENTRIES = 16384
+
+    def __init__(self, max_depth=DEFAULT_MAX_DEPTH, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_depth = max_depth
+        self.max_entries = max_entries
+        self.num_entries = 0
+        self.visited_ifds = set()
+        self.wanted = None              # (ifd, tag) pairs requested by find_tags, or None to parse every IFD
         self.url = None
         self.stream = None
+        self.endian = None
         self.ifd_start = 0
+        self.big_tiff = False
+        self.tag_table = TIFFTagTable()
         self.image_time = None
+        self.thumbnail_offset = 0
+        self.thumbnail_length = 0
 
     def init(self, stream):
         self.stream = stream
 
-    def open(self, url):
+    # If use_mmap is set then the file is memory mapped, so large files can be indexed without being read and image
+    # data is read from views of the mapping
+    def open(self, url, use_mmap=False):
         self.url = url
-        self.stream = FileStream(url, "rb")
+        if use_mmap:
+            self.stream = MmapStream(url)
+        else:
+            self.stream = FileStream(url, "rb", read_ahead=FileStream.DEFAULT_READ_AHEAD)
+
+    # Open from an asyncio.StreamReader or a file path without blocking the event loop
+    # A file is memory mapped, so only the pages that are parsed or read are loaded. IFDs and their values can be
+    # anywhere in a TIFF, so data from a StreamReader is held whole, up to AsyncStream.max_length
+    async def open_async(self, source):
+        if isinstance(source, asyncio.StreamReader):
+            stream = AsyncStream(source)
+            await stream.fill()
+            self.url = None
+            self.stream = stream
+        else:
+            await asyncio.get_running_loop().run_in_executor(None, self.open, source, True)
 
     def parse(self):
         self.parse_header()
-        next_ifd = self.parse_ifd()
+        ifd_index = 0
+        next_ifd = self.parse_ifd(ifd_index)
         while next_ifd != 0:
+            ifd_index += 1
             self.stream.set_position(self.ifd_start + next_ifd)
-            next_ifd = self.parse_ifd()
+            next_ifd = self.parse_ifd(ifd_index)
+
+        # The last valid date in the order IFD0, Exif IFD, IFD1 is the image time
+        table = self.tag_table
+        for index in range(len(table)):
+            if table.tags[index] in (0x0132, 0x9003, 0x9004) and table.types[index] == 2:
+                image_time = self.parse_time(self.get_value(index))
+                if image_time is not None:
+                    self.image_time = image_time
+
+        # The JPEG thumbnail offset is relative to the start of the TIFF header
+        thumbnail_offset = self.get_tag(0x0201, self.IFD1)
+        thumbnail_length = self.get_tag(0x0202, self.IFD1)
+        if thumbnail_offset is not None and thumbnail_length is not None:
+            self.thumbnail_offset = self.ifd_start + thumbnail_offset
+            self.thumbnail_length = thumbnail_length
+
+    # Parse only as much of the file as is needed to find the given tags and return a dict of tag to value for the
+    # tags that are present. A tag is looked for in IFD0 and then the Exif IFD; an (ifd, tag) pair looks for the tag
+    # in a specific IFD, e.g. (TIFF.GPS_IFD, 0x0002) or (TIFF.IFD1, 0x0201). Sub-IFDs and later IFDs in the chain are
+    # only read while a tag that has not been found can be in them
+    def find_tags(self, tags):
+        self.wanted = [tag if isinstance(tag, tuple) else (None, tag) for tag in tags]
+        try:
+            self.parse_header()
+            ifd_index = 0
+            next_ifd = self.parse_ifd(ifd_index)
+            while next_ifd != 0 and self.is_chain_wanted(ifd_index + 1):
+                ifd_index += 1
+                self.stream.set_position(self.ifd_start + next_ifd)
+                next_ifd = self.parse_ifd(ifd_index)
+        finally:
+            self.wanted = None
+
+        values = {}
+        for tag in tags:
+            if isinstance(tag, tuple):
+                value = self.get_tag(tag[1], tag[0])
+            else:
+                value = self.get_tag(tag, self.IFD0)
+                if value is None:
+                    value = self.get_tag(tag, self.EXIF_IFD)
+            if value is not None:
+                values[tag] = value
+        return values
+
+    # Return whether a tag requested by find_tags that has not been found yet can be in the given IFD
+    def is_wanted(self, ifd):
+        if self.wanted is None:
+            return True
+        table = self.tag_table
+        for wanted_ifd, tag in self.wanted:
+            if wanted_ifd is None:
+                if table.find(tag, self.IFD0) < 0 and table.find(tag, self.EXIF_IFD) < 0 and ifd == self.EXIF_IFD:
+                    return True
+            elif table.find(tag, wanted_ifd) < 0:
+                # The Interop IFD is a sub-IFD of the Exif IFD
+                if wanted_ifd == ifd or (wanted_ifd == self.INTEROP_IFD and ifd == self.EXIF_IFD):
+                    return True
+        return False
+
+    # Return whether a tag requested by find_tags that has not been found yet can be in the IFD at position ifd in the
+    # main chain or in an IFD after it
+    def is_chain_wanted(self, ifd):
+        if self.wanted is None:
+            return True
+        table = self.tag_table
+        for wanted_ifd, tag in self.wanted:
+            if wanted_ifd is not None and wanted_ifd not in (self.EXIF_IFD, self.GPS_IFD, self.INTEROP_IFD):
+                if wanted_ifd >= ifd and table.find(tag, wanted_ifd) < 0:
+                    return True
+        return False
 
     def parse_header(self):
         # All IFD offsets are relative to this position
@@ -40,52 +283,342 @@ class TIFF:
             self.stream.set_endian(self.stream.BIG_ENDIAN)
         else:
             raise ValueError
+        self.endian = self.stream.get_endian()
 
-        # Check signature value
-        fortytwo = self.stream.read_u16()
-        if fortytwo != 42:
+        # Check signature value; BigTIFF files use 43, followed by the offset size and a reserved field
+        signature = self.stream.read_u16()
+        if signature == 42:
+            self.big_tiff = False
+            ifd_offset = self.stream.read_u32()
+        elif signature == 43:
+            self.big_tiff = True
+            offset_size, reserved = self.stream.read_struct('HH')
+            if offset_size != 8:
+                raise ValueError
+            ifd_offset = self.stream.read_u64()
+        else:
             raise ValueError
 
         # Now we get the offset to the first IFD
-        ifd_offset = self.stream.read_u32()
         self.stream.set_position(self.ifd_start + ifd_offset)
 
-    def parse_ifd(self):
-        num_entries = self.stream.read_u16()
-        for i in range(num_entries):
-            tag = self.stream.read_u16()
-            type = self.stream.read_u16()
-            count = self.stream.read_u32()
-            offset = self.ifd_start + self.stream.read_u32()
-
-            # This tag provides an offset to another IFD
-            if tag == 0x8769:             # ExifOffset
-                self.stream.push_position(offset)
-                self.parse_ifd()
-                self.stream.pop_position()
-
-            # If tag is one of ModifyDate, DateTimeOriginal or CreateDate then attempt to extract a timestamp
-            elif tag in [0x0132, 0x9003, 0x9004]:
-                self.stream.push_position(offset)
-                time_string = self.stream.read_string(count - 1)
-                self.stream.pop_position()
-                if time_string[0:4] != "0000":
-                    try:
-                        self.image_time = datetime.datetime.strptime(time_string, "%Y:%m:%d %H:%M:%S")
-                    except ValueError:
-                        # Sometimes dates can be malformed, e.g. Feb 29 in a non-leap year. Attempt to handle this.
-                        try:
-                            dt = datetime.datetime.strptime(time_string[0:7], "%Y:%m")
-                            days = int(time_string[8:10])
-                            delta = datetime.timedelta(days-1)
-                            self.image_time = dt + delta
-                        except ValueError:
-                            pass
+    # Add the entries of the IFD at the current position to the tag table and parse the sub-IFDs it points to
+    # ifd is the identifier of the IFD in the tag table and depth its nesting below the main chain of IFDs
+    # Returns the offset of the next IFD in the chain; an IFD that has already been parsed is skipped and returns 0
+    def parse_ifd(self, ifd=IFD0, depth=0):
+        ifd_position = self.stream.get_position()
+        if ifd_position in self.visited_ifds:
+            return 0
+        self.visited_ifds.add(ifd_position)
+        if depth > self.max_depth:
+            raise ValueError("IFDs are nested too deeply")
+
+        # BigTIFF IFDs have a 64-bit entry count, 20 byte entries with 8 byte values and a 64-bit next IFD offset
+        if self.big_tiff:
+            num_entries = self.stream.read_u64()
+            entry_format, entry_size, value_size = 'HHQQ', 20, 8
+        else:
+            num_entries = self.stream.read_u16()
+            entry_format, entry_size, value_size = 'HHLL', 12, 4
+        self.num_entries += num_entries + 1
+        if self.num_entries > self.max_entries:
+            raise ValueError("Too many IFD entries")
+
+        # Read the entries and the next IFD offset at once
+        entries_length = num_entries * entry_size
+        data = self.stream.read_u8_array(entries_length + value_size)
+        if len(data) != entries_length + value_size:
+            raise ValueError("IFD is truncated")
+        data_position = self.stream.get_position() - len(data)
+        value_position = data_position + entry_size - value_size
+        sub_ifds = []
+        for tag, type, count, value in self.stream.get_struct(entry_format).iter_unpack(data[:entries_length]):
+            if type < len(type_sizes) and type_sizes[type] * count <= value_size:
+                self.tag_table.append(ifd, tag, type, count, value_position)
             else:
-                pass
+                self.tag_table.append(ifd, tag, type, count, self.ifd_start + value)
+            value_position += entry_size
+
+            # These tags provide an offset to another IFD; in BigTIFF a LONG or IFD offset is at the start of the
+            # 8 byte value field, which only equals the whole field in little endian files
+            if tag == self.EXIF_IFD or tag == self.GPS_IFD or tag == self.INTEROP_IFD:
+                if self.big_tiff and (type == 4 or type == 13):
+                    value = self.stream.get_struct('L').unpack_from(data, value_position - entry_size - data_position)[0]
+                sub_ifds.append((tag, value))
+        next_ifd = self.stream.get_struct('Q' if self.big_tiff else 'L').unpack_from(data, entries_length)[0]
 
-        next_ifd = self.stream.read_u32()
+        for tag, offset in sub_ifds:
+            if not self.is_wanted(tag):
+                continue
+            self.stream.push_position(self.ifd_start + offset)
+            self.parse_ifd(tag, depth + 1)
+            self.stream.pop_position()
         return next_ifd
 
+    # Return the values of an integer tag in ifd as an array, or None if the tag is not present
+    def get_array(self, tag, ifd=IFD0):
+        index = self.tag_table.find(tag, ifd)
+        if index < 0:
+            return None
+        table = self.tag_table
+        type = table.types[index]
+        if type < len(type_sizes) and table.value_positions[index] + table.counts[index] * type_sizes[type] > \
+                self.stream.get_length():
+            raise ValueError("Tag %#06x value is truncated" % tag)
+        self.stream.push_position(table.value_positions[index])
+        self.stream.push_endian(self.endian)
+        try:
+            if type == 3:
+                values = self.stream.read_u16_array(table.counts[index])
+            elif type == 4 or type == 13:
+                values = self.stream.read_u32_array(table.counts[index])
+            elif type == 16 or type == 18:
+                values = self.stream.read_u64_array(table.counts[index])
+            else:
+                raise ValueError("Tag %#06x is not an integer array" % tag)
+        finally:
+            self.stream.pop_endian()
+            self.stream.pop_position()
+        return values
+
+    # Return the value of tag in ifd, or None if the tag is not present
+    def get_tag(self, tag, ifd=IFD0):
+        index = self.tag_table.find(tag, ifd)
+        return self.get_value(index) if index >= 0 else None
+
+    # Decode the value of the entry at index in the tag table. ASCII values are returned as a string and BYTE and
+    # UNDEFINED values as bytes; numeric values are returned as a number if there is one element, otherwise as a tuple.
+    # Rationals are returned as (numerator, denominator) pairs
+    def get_value(self, index):
+        table = self.tag_table
+        type = table.types[index]
+        count = table.counts[index]
+        length = count * (type_sizes[type] if 0 < type < len(type_sizes) and type_sizes[type] else 1)
+        if table.value_positions[index] + length > self.stream.get_length():
+            raise ValueError("Tag %#06x value is truncated" % table.tags[index])
+        self.stream.push_position(table.value_positions[index])
+        self.stream.push_endian(self.endian)
+        try:
+            if type == 2:
+                value = self.stream.read_string(count).split('\x00', 1)[0]
+            elif type in type_formats:
+                # Rationals are decoded as (numerator, denominator) pairs
+                if type == 5 or type == 10:
+                    element = self.stream.get_struct(type_formats[type] * 2)
+                    value = tuple(element.iter_unpack(self.stream.read_u8_array(length)))
+                else:
+                    element = self.stream.get_struct(type_formats[type])
+                    value = tuple(item for item, in element.iter_unpack(self.stream.read_u8_array(length)))
+                if count == 1:
+                    value = value[0]
+            else:
+                value = bytes(self.stream.read_u8_array(length))
+        finally:
+            self.stream.pop_endian()
+            self.stream.pop_position()
+        return value
+
+    @staticmethod
+    def parse_time(time_string):
+        if time_string[0:4] == "0000":
+            return None
+        try:
+            return datetime.datetime.strptime(time_string[0:19], "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            # Sometimes dates can be malformed, e.g. Feb 29 in a non-leap year. Attempt to handle this.
+            try:
+                dt = datetime.datetime.strptime(time_string[0:7], "%Y:%m")
+                days = int(time_string[8:10])
+                delta = datetime.timedelta(days-1)
+                return dt + delta
+            except ValueError:
+                return None
+
     def get_image_time(self):
         return self.image_time
+
+    def get_orientation(self):
+        return self.get_tag(0x0112)
+
+    def get_camera_make(self):
+        return self.get_tag(0x010f)
+
+    def get_camera_model(self):
+        return self.get_tag(0x0110)
+
+    # Return the GPS position as (latitude, longitude) in signed degrees, or None if the image has no GPS position
+    def get_gps_position(self):
+        latitude = self.get_tag(0x0002, self.GPS_IFD)
+        longitude = self.get_tag(0x0004, self.GPS_IFD)
+        if latitude is None or longitude is None:
+            return None
+        position = []
+        for reference, value, negative in ((0x0001, latitude, 'S'), (0x0003, longitude, 'W')):
+            degrees = 0.0
+            for scale, (numerator, denominator) in zip((1, 60, 3600), value):
+                if denominator:
+                    degrees += numerator / denominator / scale
+            if self.get_tag(reference, self.GPS_IFD) == negative:
+                degrees = -degrees
+            position.append(degrees)
+        return tuple(position)
+
+    # Return the layout of the image data of ifd as a TIFFImage
+    def get_image(self, ifd=IFD0):
+        image = TIFFImage()
+        image.width = self.get_tag(0x0100, ifd)
+        image.height = self.get_tag(0x0101, ifd)
+        if image.width is None or image.height is None:
+            raise ValueError("IFD has no image")
+        image.samples_per_pixel = self.get_tag(0x0115, ifd) or 1
+        bits_per_sample = self.get_tag(0x0102, ifd) or 1
+        if isinstance(bits_per_sample, tuple):
+            if len(set(bits_per_sample)) != 1:
+                raise ValueError("Samples of different sizes are not supported")
+            bits_per_sample = bits_per_sample[0]
+        if bits_per_sample not in (8, 16, 32, 64):
+            raise ValueError("Unsupported bits per sample")
+        image.bits_per_sample = bits_per_sample
+        image.compression = self.get_tag(0x0103, ifd) or 1
+        if image.compression not in (1, 5, 8, 32773, 32946):
+            raise ValueError("Unsupported compression")
+        image.predictor = self.get_tag(0x013d, ifd) or 1
+        if image.predictor not in (1, 2):
+            raise ValueError("Unsupported predictor")
+        if (self.get_tag(0x011c, ifd) or 1) != 1 and image.samples_per_pixel > 1:
+            raise ValueError("Planar configuration is not supported")
+
+        if self.tag_table.find(0x0144, ifd) >= 0:
+            image.chunk_width = self.get_tag(0x0142, ifd)
+            image.chunk_height = self.get_tag(0x0143, ifd)
+            image.offsets = self.get_array(0x0144, ifd)
+            image.byte_counts = self.get_array(0x0145, ifd)
+        else:
+            image.chunk_width = image.width
+            image.chunk_height = min(self.get_tag(0x0116, ifd) or image.height, image.height)
+            image.offsets = self.get_array(0x0111, ifd)
+            image.byte_counts = self.get_array(0x0117, ifd)
+        # Chunk indexes are held as 64-bit arrays whether the file is a TIFF or a BigTIFF
+        if image.offsets is not None and image.offsets.typecode != 'Q':
+            image.offsets = array.array('Q', image.offsets)
+        if image.byte_counts is not None and image.byte_counts.typecode != 'Q':
+            image.byte_counts = array.array('Q', image.byte_counts)
+        image.chunks_across = (image.width + image.chunk_width - 1) // image.chunk_width
+        chunks_down = (image.height + image.chunk_height - 1) // image.chunk_height
+        if image.offsets is None or image.byte_counts is None or \
+                min(len(image.offsets), len(image.byte_counts)) < image.chunks_across * chunks_down:
+            raise ValueError("Image data offsets are missing")
+        return image
+
+    # Decompress one strip or tile and undo the predictor; returns the rows of the chunk
+    def decode_chunk(self, image, data):
+        if image.compression == 1:
+            data = bytearray(data)
+        elif image.compression == 5:
+            data = decode_lzw(data)
+        elif image.compression == 8 or image.compression == 32946:
+            data = bytearray(zlib.decompress(data))
+        else:
+            data = decode_packbits(data)
+
+        if image.predictor == 2:
+            # Horizontal differencing: each sample is stored as the difference from the same sample of the previous pixel
+            samples = image.samples_per_pixel
+            row_samples = image.chunk_width * samples
+            bytes_per_sample = image.bits_per_sample // 8
+            typecode = {1: 'B', 2: 'H', 4: U32_TYPECODE, 8: 'Q'}[bytes_per_sample]
+            num_rows = len(data) // (row_samples * bytes_per_sample)
+            data = data[:num_rows * row_samples * bytes_per_sample]
+            if numpy is not None:
+                dtype = numpy.dtype('u%d' % bytes_per_sample).newbyteorder('<' if self.endian == self.stream.LITTLE_ENDIAN else '>')
+                values = numpy.frombuffer(data, dtype).reshape(num_rows, image.chunk_width, samples)
+                data = bytearray(numpy.cumsum(values, 1, dtype).astype(dtype).tobytes())
+            else:
+                values = array.array(typecode, data)
+                swap = (self.endian == self.stream.LITTLE_ENDIAN) != (sys.byteorder == 'little')
+                if swap:
+                    values.byteswap()
+                mask = (1 << image.bits_per_sample) - 1
+                for row in range(0, len(values), row_samples):
+                    for i in range(row + samples, row + row_samples):
+                        values[i] = (values[i] + values[i - samples]) & mask
+                if swap:
+                    values.byteswap()
+                data = bytearray(values.tobytes())
+        return data
+
+    # Read a rectangle of pixels from the image of ifd, decompressing only the strips or tiles that it intersects on a
+    # pool of max_workers threads. Returns the rows of the rectangle as bytes with samples in the file's byte order, or
+    # a (height, width, samples) NumPy array if as_numpy is set and NumPy is installed
+    def read_region(self, x, y, width, height, ifd=IFD0, max_workers=None, as_numpy=False):
+        image = self.get_image(ifd)
+        if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > image.width or y + height > image.height:
+            raise ValueError("Region is outside the image")
+        bytes_per_pixel = image.get_bytes_per_pixel()
+        row_length = width * bytes_per_pixel
+        chunk_row_length = image.chunk_width * bytes_per_pixel
+        result = bytearray(row_length * height)
+
+        # Wait for a chunk to be decoded and copy the part of each of its rows that falls within the region
+        def copy_chunk(chunk_column, chunk_row, future):
+            data = future.result()
+            chunk_x = chunk_column * image.chunk_width
+            chunk_y = chunk_row * image.chunk_height
+            left = max(x, chunk_x)
+            right = min(x + width, chunk_x + image.chunk_width)
+            top = max(y, chunk_y)
+            bottom = min(y + height, chunk_y + image.chunk_height)
+            start = (left - chunk_x) * bytes_per_pixel
+            length = (right - left) * bytes_per_pixel
+            destination = (top - y) * row_length + (left - x) * bytes_per_pixel
+            for source in range((top - chunk_y) * chunk_row_length, (bottom - chunk_y) * chunk_row_length,
+                                chunk_row_length):
+                source += start
+                if source + length > len(data):
+                    raise ValueError("Image data is truncated")
+                result[destination:destination + length] = data[source:source + length]
+                destination += row_length
+
+        # Read the compressed chunks here, since streams are not thread safe, and decompress them on the pool. At most
+        # two chunks per worker are read ahead of the copy, so only a bounded part of the compressed data is held
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        first_column = x // image.chunk_width
+        last_column = (x + width - 1) // image.chunk_width
+        first_row = y // image.chunk_height
+        last_row = (y + height - 1) // image.chunk_height
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            for chunk_row in range(first_row, last_row + 1):
+                for chunk_column in range(first_column, last_column + 1):
+                    index = chunk_row * image.chunks_across + chunk_column
+                    self.stream.push_position(self.ifd_start + image.offsets[index])
+                    data = self.stream.read_u8_array(image.byte_counts[index])
+                    self.stream.pop_position()
+                    pending.append((chunk_column, chunk_row, executor.submit(self.decode_chunk, image, data)))
+                    if len(pending) >= max_workers * 2:
+                        copy_chunk(*pending.popleft())
+            while pending:
+                copy_chunk(*pending.popleft())
+
+        if as_numpy and numpy is not None:
+            dtype = numpy.dtype('u%d' % (image.bits_per_sample // 8))
+            dtype = dtype.newbyteorder('<' if self.endian == self.stream.LITTLE_ENDIAN else '>')
+            return numpy.frombuffer(result, dtype).reshape(height, width, image.samples_per_pixel)
+        return result
+
+    def read_image(self, ifd=IFD0, max_workers=None, as_numpy=False):
+        image = self.get_image(ifd)
+        return self.read_region(0, 0, image.width, image.height, ifd, max_workers, as_numpy)
+
+    # Return the JPEG thumbnail of an Exif IFD1 without decoding it, or None if there is no thumbnail
+    # With a memory mapped stream the thumbnail is a view of the mapping
+    def get_thumbnail(self):
+        if self.thumbnail_offset == 0 or self.thumbnail_length == 0:
+            return None
+        if self.thumbnail_offset + self.thumbnail_length > self.stream.get_length():
+            raise ValueError("Thumbnail is outside the file")
+        self.stream.push_position(self.thumbnail_offset)
+        thumbnail = self.stream.read_u8_array(self.thumbnail_length)
+        self.stream.pop_position()
+        return thumbnail
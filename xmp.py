@@ -0,0 +1,90 @@
+# Copyright is waived. No warranty is provided. Unrestricted use and modification is permitted.
+
+# For XMP format see https://www.adobe.com/devnet/xmp.html
+
+import xml.etree.ElementTree as ET
+
+# Prefixes that can be used in property names instead of the full namespace
+namespaces = {
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'exif': 'http://ns.adobe.com/exif/1.0/',
+    'photoshop': 'http://ns.adobe.com/photoshop/1.0/',
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'tiff': 'http://ns.adobe.com/tiff/1.0/',
+    'xmp': 'http://ns.adobe.com/xap/1.0/',
+    'xmpMM': 'http://ns.adobe.com/xap/1.0/mm/',
+}
+
+# Amount of the packet passed to the parser at a time; parsing stops at the end of the chunk holding the last property
+CHUNK_SIZE = 16384
+
+# Compiled lookups shared by all scans; keyed by the tuple of property names
+property_lookups = {}
+
+
+# Compile property names given as 'prefix:Name' or '{namespace}Name' into a map of element/attribute names to property
+# names, and the local names used to reject packets that cannot hold any of the properties without parsing them
+def get_property_lookup(properties):
+    lookup = property_lookups.get(properties)
+    if lookup is None:
+        names = {}
+        local_names = []
+        for name in properties:
+            if name.startswith('{'):
+                qualified_name = name
+            else:
+                prefix, local_name = name.split(':', 1)
+                qualified_name = '{%s}%s' % (namespaces[prefix], local_name)
+            names[qualified_name] = name
+            local_names.append(qualified_name[qualified_name.index('}') + 1:].encode('utf-8'))
+        lookup = (names, tuple(local_names))
+        property_lookups[properties] = lookup
+    return lookup
+
+
+# Extract the given properties from an XMP packet; returns a dict of property name to text value for the properties
+# that were found. A property can be an attribute of an rdf:Description or an element; for an element holding an
+# rdf:Seq, rdf:Bag or rdf:Alt the text of its first item is returned
+def find_properties(data, properties):
+    names, local_names = get_property_lookup(tuple(properties))
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    elif not isinstance(data, bytes):
+        data = bytes(data)
+
+    # Skip parsing if none of the properties are named anywhere in the packet
+    if not any(local_name in data for local_name in local_names):
+        return {}
+
+    values = {}
+    depth = 0       # number of open property elements, whose children are needed for their value
+    parser = ET.XMLPullParser(('start', 'end'))
+    try:
+        for start in range(0, len(data), CHUNK_SIZE):
+            parser.feed(data[start:start + CHUNK_SIZE])
+            for event, element in parser.read_events():
+                if event == 'start':
+                    for attribute in element.attrib:
+                        name = names.get(attribute)
+                        if name is not None and name not in values:
+                            values[name] = element.attrib[attribute]
+                    if element.tag in names:
+                        depth += 1
+                else:
+                    name = names.get(element.tag)
+                    if name is not None:
+                        depth -= 1
+                        if name not in values:
+                            text = element.text.strip() if element.text else ''
+                            if not text and len(element):
+                                text = next((item.text for item in element.iter() if item.text and item.text.strip()), '')
+                            values[name] = text.strip()
+                    # Children of finished elements are no longer needed unless they are part of a property value
+                    if depth == 0:
+                        element.clear()
+            if len(values) == len(names):
+                break
+    except ET.ParseError:
+        # Padding after the packet, such as trailing nulls, is not well formed; keep what was found before it
+        pass
+    return values